@@ -1,18 +1,26 @@
 #!/usr/bin/env python3
 
 import argparse
-import concurrent.futures
+import bisect
+import contextlib
+import copy
 import csv
 import datetime
-import dateutil
+import hashlib
+import io
 import json
 import logging
-import memoization
+import operator
 import os
-import pprint
+import resource
+import shutil
 import sys
+import time
+import traceback
 
-import matplotlib.pyplot as plt
+# matplotlib, dateutil and everything only needed for rendering reports
+# (worker pools, shared memory, profiling) or --store are imported where
+# they're needed, so --metrics-only starts quickly, see import_plotting()
 import numpy as np
 
 HEADER_ORDER = [
@@ -37,6 +45,10 @@ HEADER_ORDER = [
     'User Change Insulin (units)',
 ]
 
+# the columns parse_cgm_chunks() uses, the rest of each line is dropped as soon
+# as it's read
+PARSED_HEADERS = ('Device Timestamp', 'Record Type', 'Historic Glucose mg/dL', 'Scan Glucose mg/dL', 'Serial Number', 'Notes')
+
 BUILT_IN_HEADERS = {
     'Device': 'device',
     'Serial Number': 'sn',
@@ -59,6 +71,92 @@ BUILT_IN_HEADERS = {
     'User Change Insulin (units)': 'user_change_insulin',
 }
 
+# The format LibreView uses for 'Device Timestamp', e.g. '12-28-2021 06:40 PM'.
+# Anything that doesn't match it exactly falls back to dateutil.
+DEVICE_TIMESTAMP_FORMAT = "%m-%d-%Y %I:%M %p"
+DEVICE_TIMESTAMP_LENGTH = 19
+
+# sentinel stored in the int16 glucose column when a row has no reading
+GLUCOSE_MISSING = -1
+
+# sentinel stored in the record type column when a row has no type
+RECORD_TYPE_MISSING = -1
+
+RECORD_TYPE_HISTORIC = 0
+RECORD_TYPE_SCAN = 1
+
+# when more than one record has a reading for the same minute, the glucose
+# of the one whose type comes first here is the one that counts
+GLUCOSE_PRECEDENCE = (RECORD_TYPE_SCAN, RECORD_TYPE_HISTORIC)
+
+# how many csv rows to convert to columns at a time.  The rows are python
+# strings until then, which is most of the memory used while parsing, and
+# bigger chunks aren't any faster.
+CSV_CHUNK_ROWS = 16384
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# bump this whenever the parsed representation changes so old cache entries
+# are ignored
+PARSE_CACHE_VERSION = 2
+
+# bump this whenever a change to the plotting code changes what the graphs
+# look like, so incremental runs don't carry old graphs forward
+REPORT_FORMAT_VERSION = 9
+
+# config values that change what a graph looks like
+REPORT_CONFIG_KEYS = ('target_min', 'target_max', 'time_in_tz_min', 'time_in_tz_max', 'time_in_tz_warn', 'weeks_start_on', 'full_resolution', 'max_gap_minutes')
+
+# long graphs are drawn with at most a min and a max point per bucket, about
+# one bucket per pixel column of a 20 inch wide figure
+DOWNSAMPLE_BUCKETS = 2000
+
+# readings further apart than this count as a gap in the data, which is
+# left out of the time in target and the statistics (see --max-gap-minutes)
+DEFAULT_MAX_GAP_SECONDS = 3600
+
+# zone (see get_tz_state()) of the stretches of the time in target index
+# that are in a gap
+TZ_STATE_GAP = 2
+
+# glucose statistics are calculated on a regular grid of this many seconds,
+# and windows with less than STATS_MIN_COVERAGE of their time covered get
+# no statistics
+STATS_GRID_SECONDS = 300
+STATS_MIN_COVERAGE = 0.7
+
+# ambulatory glucose profiles bin readings by time of day into buckets this
+# many minutes wide, and draw these percentiles of each bucket
+AGP_BUCKET_MINUTES = 15
+AGP_PERCENTILES = (5, 25, 50, 75, 95)
+
+# rough cost model of a report task in seconds on one core, used to hand
+# out the most expensive ones first.  savefig dominates, and every note
+# drawn on a graph makes it a lot slower; rows and plotted points matter much
+# less.
+REPORT_COST_BASE = 0.2
+REPORT_COST_PER_NOTE = 0.03
+REPORT_COST_PER_ROW = 2e-7
+REPORT_COST_PER_POINT = 2e-5
+
+# how many patients --batch keeps in flight at once: their graphs queued in
+# the pool and their data in shared memory.  Enough that the workers always
+# have a patient to render while the next one loads, without holding every
+# patient in memory.  Workers keep this many datasets attached and this many
+# renderers of each kind as well.
+BATCH_PATIENTS_IN_FLIGHT = 4
+
+# what a patient in a --batch manifest can set: their name and files, and
+# per patient overrides of the report options
+BATCH_PATIENT_KEYS = ('name', 'cgm_data', 'notes_data') + REPORT_CONFIG_KEYS
+
+# columns of the dataset with one entry per csv row, these are the ones that
+# get cut down when a task only needs a slice of the data
+ROW_COLUMNS = ('time', 'glucose', 'type', 'sn')
+
+# columns in shared memory start on a cache line
+SHARED_COLUMN_ALIGNMENT = 64
+
 """
 Example row:
 [{'carbs_g': '',
@@ -87,183 +185,1959 @@ def date_to_output(datetime):
     return datetime.strftime("%Y%m%d_%H%M%S")
 
 
-def main(config):
-    logging.basicConfig()
-    logging.getLogger().setLevel(logging.DEBUG)
-    logging.getLogger('matplotlib').setLevel(logging.INFO)
+def datetime_to_epoch(dt):
+    """
+    Converts a datetime into the seconds-since-epoch representation used by
+    the columnar data.
 
-    time_data = []
-    data = {}
-    #config = {
-    #    'target_min': 70,
-    #    'target_max': 180,
-    #    'time_in_tz_min': 80.0,
-    #    'time_in_tz_max': 100.0,
-    #    'time_in_tz_warn': 70.0,
-    #    'weeks_start_on': 6,  # 6 = sunday
-    #}
+    Device timestamps carry no timezone, so the columns store the device's
+    wall clock time as if it were UTC.  Naive datetimes are treated the same
+    way; aware datetimes are first converted to local wall clock time.
+    """
+    if dt.tzinfo is not None:
+        dt = dt.astimezone().replace(tzinfo=None)
+    return (dt - EPOCH).total_seconds()
 
-    # first parse any cgm data
-    for filepath in config.cgm_data:
+
+def epoch_to_datetime(ts):
+    """
+    Inverse of datetime_to_epoch(), returns a naive datetime.
+    """
+    return EPOCH + datetime.timedelta(seconds=float(ts))
+
+
+def parse_device_timestamps(timestamps):
+    """
+    Parses a list of 'Device Timestamp' strings into an int64 array of epoch
+    seconds (see datetime_to_epoch()).
+
+    Strings in the usual LibreView format are decoded with array math on their
+    bytes, anything else is handed to dateutil one at a time.
+    """
+    count = len(timestamps)
+    try:
+        raw = np.array(timestamps, dtype=f"S{DEVICE_TIMESTAMP_LENGTH + 1}")
+    except UnicodeEncodeError:
+        # not ascii, certainly not the usual format.  Blank out the odd ones
+        # so they all go through dateutil.
+        raw = np.array([t if t.isascii() else '' for t in timestamps], dtype=f"S{DEVICE_TIMESTAMP_LENGTH + 1}")
+    chars = raw.view(np.uint8).reshape(count, DEVICE_TIMESTAMP_LENGTH + 1)[:, :DEVICE_TIMESTAMP_LENGTH]
+    digits = chars.astype(np.int64) - ord('0')
+
+    def number(start, end):
+        value = np.zeros(count, dtype=np.int64)
+        for i in range(start, end):
+            value = value * 10 + digits[:, i]
+        return value
+
+    # 'MM-DD-YYYY HH:MM AM'
+    digit_columns = [0, 1, 3, 4, 6, 7, 8, 9, 11, 12, 14, 15]
+    matches = np.all((digits[:, digit_columns] >= 0) & (digits[:, digit_columns] <= 9), axis=1)
+    matches &= (chars[:, 2] == ord('-')) & (chars[:, 5] == ord('-')) & (chars[:, 10] == ord(' '))
+    matches &= (chars[:, 13] == ord(':')) & (chars[:, 16] == ord(' ')) & (chars[:, 18] == ord('M'))
+    matches &= (chars[:, 17] == ord('A')) | (chars[:, 17] == ord('P'))
+    matches &= (raw.view(np.uint8).reshape(count, DEVICE_TIMESTAMP_LENGTH + 1)[:, DEVICE_TIMESTAMP_LENGTH] == 0)
+
+    months = number(0, 2)
+    days = number(3, 5)
+    years = number(6, 10)
+    hours = number(11, 13)
+    minutes = number(14, 16)
+    matches &= (months >= 1) & (months <= 12) & (days >= 1) & (days <= 31)
+    matches &= (hours >= 1) & (hours <= 12) & (minutes <= 59)
+
+    # keep the date math below from blowing up on rows we will reparse anyways
+    months = np.where(matches, months, 1)
+    days = np.where(matches, days, 1)
+    years = np.where(matches, years, 1970)
+
+    dates = (years - 1970).astype('datetime64[Y]').astype('datetime64[M]') + (months - 1)
+    dates = dates.astype('datetime64[D]') + (days - 1)
+    # a day that doesn't exist in its month (e.g. 02-30) rolls over, catch it
+    matches &= (dates.astype('datetime64[M]') - dates.astype('datetime64[Y]').astype('datetime64[M]')).astype(np.int64) == (months - 1)
+    hours = (hours % 12) + np.where(chars[:, 17] == ord('P'), 12, 0)
+    seconds = dates.astype(np.int64) * 86400 + hours * 3600 + minutes * 60
+
+    if not matches.all():
+        import dateutil.parser
+    for i in np.flatnonzero(~matches):
+        seconds[i] = int(datetime_to_epoch(dateutil.parser.parse(timestamps[i])))
+    return seconds
+
+
+def parse_int_column(values, missing):
+    """
+    Converts a column of strings into an int array, using the given sentinel
+    for empty values.
+    """
+    column = np.array(values)
+    empty = (column == '')
+    try:
+        parsed = np.where(empty, str(missing), column).astype(np.int64)
+    except ValueError:
+        # some exports have things like '98.0', do it the slow way
+        parsed = np.array([missing if v == '' else int(float(v)) for v in values], dtype=np.int64)
+    return parsed
+
+
+def read_cgm_chunks(f):
+    """
+    Reads the csv rows (after the two header lines) from a libreview export
+    in chunks, yielding each chunk as a dict of the PARSED_HEADERS columns.
+    """
+    csv_rows = csv.reader(f)
+    # only hold on to the fields we need, most of a row is other columns
+    pick = operator.itemgetter(*[HEADER_ORDER.index(header) for header in PARSED_HEADERS])
+    while True:
+        chunk = []
+        for line in csv_rows:
+            if len(line) < len(HEADER_ORDER):
+                line = line + [''] * (len(HEADER_ORDER) - len(line))
+            chunk.append(pick(line))
+            if len(chunk) >= CSV_CHUNK_ROWS:
+                break
+        if not chunk:
+            return
+        yield dict(zip(PARSED_HEADERS, zip(*chunk)))
+
+
+def parse_cgm_chunks(f, serial_codes):
+    """
+    Parses the csv rows of a libreview export from f (positioned after the
+    two header lines) CSV_CHUNK_ROWS rows at a time, in file order, yielding
+    each chunk as columns:
+        'time': int64 epoch seconds (see datetime_to_epoch())
+        'glucose': int16 glucose in mg/dL, scan glucose for scans and historic
+            glucose for historic readings, GLUCOSE_MISSING if the row has neither
+        'type': int8 libreview record type, RECORD_TYPE_MISSING if empty
+        'sn': int32 serial number, as its index in serial_codes (a dict of
+            serial number to index that new serial numbers get added to)
+        'note': object array of note text, or None for rows without one
+    """
+    for chunk in read_cgm_chunks(f):
+        scan = parse_int_column(chunk['Scan Glucose mg/dL'], GLUCOSE_MISSING)
+        historic = parse_int_column(chunk['Historic Glucose mg/dL'], GLUCOSE_MISSING)
+        serial_column = chunk['Serial Number']
+        if serial_column.count(serial_column[0]) == len(serial_column):
+            # nearly always the case, one export is normally one sensor
+            sn = np.full(len(serial_column), serial_codes.setdefault(serial_column[0], len(serial_codes)), dtype=np.int32)
+        else:
+            serials, sn = np.unique(np.array(serial_column, dtype=str), return_inverse=True)
+            codes = np.array([serial_codes.setdefault(serial, len(serial_codes)) for serial in serials.tolist()], dtype=np.int32)
+            sn = codes[sn.reshape(-1)]
+        yield {
+            'time': parse_device_timestamps(chunk['Device Timestamp']),
+            'glucose': np.where(scan != GLUCOSE_MISSING, scan, historic).astype(np.int16),
+            'type': parse_int_column(chunk['Record Type'], RECORD_TYPE_MISSING).astype(np.int8),
+            'sn': sn,
+            'note': np.array([text or None for text in chunk['Notes']], dtype=object),
+        }
+
+
+def iter_cgm_csv_chunks(filepath, serial_codes):
+    """
+    Reads a libreview export a chunk at a time, see parse_cgm_chunks().
+    """
+    row_count = 0
+    with open(filepath) as f:
+        created_by = f.readline()
+        headers = f.readline().strip().split(",")
+        for chunk in parse_cgm_chunks(f, serial_codes):
+            row_count += len(chunk['time'])
+            yield chunk
+    logging.debug(f"Read {row_count} rows from {filepath}")
+
+
+def sort_cgm_chunks(chunks):
+    """
+    Joins chunks from parse_cgm_chunks() into the columns of one file:
+    'time', 'glucose', 'type' and 'sn' sorted by time (keeping file order
+    for rows with the same timestamp), and 'notes', a dict of row index to
+    note text for rows that have one.
+    """
+    chunks = list(chunks)
+    data = concatenate_chunks(chunks)
+    notes = {}
+    row_count = 0
+    for chunk in chunks:
+        for idx in np.flatnonzero(chunk['note'] != None).tolist():  # noqa: E711
+            notes[row_count + idx] = chunk['note'][idx]
+        row_count += len(chunk['time'])
+    # exports are normally in time order already, but nothing guarantees it
+    if np.any(data['time'][1:] < data['time'][:-1]):
+        order = np.argsort(data['time'], kind='stable')
+        for name in ROW_COLUMNS:
+            data[name] = data[name][order]
+        new_row = np.empty(row_count, dtype=np.int64)
+        new_row[order] = np.arange(row_count)
+        notes = {int(new_row[idx]): text for idx, text in notes.items()}
+    data['notes'] = notes
+    return data
+
+
+def read_cgm_file(filepath):
+    """
+    Reads a single libreview export into the columns described in
+    sort_cgm_chunks(), plus 'serials', the list of the serial numbers 'sn'
+    refers to.
+    """
+    serial_codes = {}
+    data = sort_cgm_chunks(iter_cgm_csv_chunks(filepath, serial_codes))
+    data['serials'] = list(serial_codes)
+    return data
+
+
+def iter_cgm_file_chunks(columns, file_idx, chunk_rows=CSV_CHUNK_ROWS):
+    """
+    Yields consecutive slices of a file read by read_cgm_file() as the
+    chunks merge_cgm_chunks() expects: the row columns plus 'file' (which
+    input they came from) and 'note' (note text or None).
+    """
+    note_rows = sorted(columns['notes'])
+    row_count = len(columns['time'])
+    for start in range(0, row_count, chunk_rows):
+        end = min(start + chunk_rows, row_count)
+        note = np.full(end - start, None, dtype=object)
+        for idx in note_rows[bisect.bisect_left(note_rows, start):bisect.bisect_left(note_rows, end)]:
+            note[idx - start] = columns['notes'][idx]
+        yield {
+            'time': columns['time'][start:end],
+            'glucose': columns['glucose'][start:end],
+            'type': columns['type'][start:end],
+            'sn': columns['sn'][start:end],
+            'file': np.full(end - start, file_idx, dtype=np.int32),
+            'note': note,
+        }
+
+
+def merge_cgm_chunks(streams):
+    """
+    k-way merge of the given chunk streams (see iter_cgm_file_chunks()), each
+    of which has to be sorted by time.  Yields sorted, de-duplicated chunks.
+
+    Only the current chunk of each stream is held at a time: everything up to
+    the earliest of their last timestamps can't be affected by anything still
+    to come, so it gets merged and yielded before reading on.
+    """
+    streams = [iter(stream) for stream in streams]
+    heads = [next(stream, None) for stream in streams]
+    while any(head is not None for head in heads):
+        bound = min(head['time'][-1] for head in heads if head is not None)
+        pieces = []
+        for i, stream in enumerate(streams):
+            # rows at the bound may carry on into the stream's next chunk
+            while heads[i] is not None and heads[i]['time'][0] <= bound:
+                head = heads[i]
+                cut = np.searchsorted(head['time'], bound, side='right')
+                pieces.append({name: column[:cut] for name, column in head.items()})
+                if cut < len(head['time']):
+                    heads[i] = {name: column[cut:] for name, column in head.items()}
+                else:
+                    heads[i] = next(stream, None)
+        yield dedupe_cgm_rows({name: np.concatenate([piece[name] for piece in pieces]) for name in pieces[0]})
+
+
+def dedupe_cgm_rows(rows):
+    """
+    Sorts a merged chunk by time and drops duplicate records: the same
+    (serial number, timestamp, record type) shows up in every export that
+    covers it, only the one from the last file given is kept.
+
+    Separate records can still have a reading at the same minute (a scan
+    during a historic reading, or two sensors).  Those rows are all kept, but
+    only the one whose type comes first in GLUCOSE_PRECEDENCE (then the
+    later file) keeps its glucose, so the glucose series has one reading
+    per timestamp.
+    """
+    order = np.lexsort((rows['file'], rows['type'], rows['sn'], rows['time']))
+    rows = {name: column[order] for name, column in rows.items()}
+    is_last = np.ones(len(order), dtype=bool)
+    is_last[:-1] = (
+        (rows['time'][1:] != rows['time'][:-1])
+        | (rows['sn'][1:] != rows['sn'][:-1])
+        | (rows['type'][1:] != rows['type'][:-1])
+    )
+    rows = {name: column[is_last] for name, column in rows.items()}
+
+    readings = np.flatnonzero(rows['glucose'] != GLUCOSE_MISSING)
+    rank = np.full(len(readings), len(GLUCOSE_PRECEDENCE), dtype=np.int32)
+    for i, record_type in enumerate(GLUCOSE_PRECEDENCE):
+        rank[rows['type'][readings] == record_type] = i
+    order = np.lexsort((-rows['file'][readings], rank, rows['time'][readings]))
+    readings = readings[order]
+    shadowed = readings[1:][rows['time'][readings[1:]] == rows['time'][readings[:-1]]]
+    if len(shadowed):
+        rows['glucose'] = rows['glucose'].copy()
+        rows['glucose'][shadowed] = GLUCOSE_MISSING
+    return rows
+
+
+def check_time_order(filepath, chunks):
+    """
+    Passes chunks read straight from a file through, making sure the file
+    really is in time order, which merging without sorting it first needs.
+    """
+    last = None
+    for chunk in chunks:
+        times = chunk['time']
+        if len(times) and (np.any(times[1:] < times[:-1]) or (last is not None and times[0] < last)):
+            raise ValueError(f"{filepath} is not in time order, so it can't be streamed (run without --streaming)")
+        if len(times):
+            last = times[-1]
+        yield chunk
+
+
+def iter_cgm_data(filepaths, serial_codes, cache=None, streaming=False):
+    """
+    Reads all the given libreview exports and yields the merged rows (see
+    merge_cgm_chunks()) in time order, a chunk at a time.  Serial numbers
+    are numbered in serial_codes.
+
+    Normally every file is read (or loaded from the ParseCache, if given)
+    and sorted before merging.  With streaming, files are merged straight
+    from the csv instead, so only a chunk of each is in memory at a time;
+    that skips the cache and needs every file to be in time order.
+    """
+    streams = []
+    for file_idx, filepath in enumerate(filepaths):
         logging.info(f"Reading in CGM data file {filepath}")
-        with open(filepath) as f:
-            created_by = f.readline()
-            headers = f.readline().strip().split(",")
-            csv_rows = csv.reader(f)
-            for line in csv_rows:
-                row = {}
-                for header_idx in range(len(HEADER_ORDER)):
-                    row[BUILT_IN_HEADERS[HEADER_ORDER[header_idx]]] = line[header_idx]
-                row['datetime'] = dateutil.parser.parse(row['timestamp'])
-                row['time'] = row['datetime'].timestamp()
-                time_data.append(row['time'])
-                data[row['time']] = row
+        if streaming:
+            chunks = check_time_order(filepath, iter_cgm_csv_chunks(filepath, serial_codes))
+            streams.append({**chunk, 'file': np.full(len(chunk['time']), file_idx, dtype=np.int32)} for chunk in chunks)
+            continue
+        if cache is None:
+            columns = read_cgm_file(filepath)
+        else:
+            columns = cache.get_or_parse(filepath, ".npz", read_cgm_file, save_cgm_file, load_cgm_file)
+        # serial numbers are numbered per file, renumber them for the dataset
+        codes = np.array([serial_codes.setdefault(serial, len(serial_codes)) for serial in columns['serials']], dtype=np.int32)
+        columns['sn'] = codes[columns['sn']]
+        streams.append(iter_cgm_file_chunks(columns, file_idx))
+    for chunk in merge_cgm_chunks(streams):
+        del chunk['file']
+        yield chunk
+
+
+def collect_notes(chunks, note_time, note_text):
+    """
+    Appends the notes in each chunk to note_time and note_text, and passes
+    the chunks on without them.
+    """
+    for chunk in chunks:
+        note = chunk.pop('note')
+        for idx in np.flatnonzero(note != None).tolist():  # noqa: E711
+            note_time.append(int(chunk['time'][idx]))
+            note_text.append(note[idx])
+        yield chunk
 
-    # parse any notes data
-    for filepath in config.notes_data:
-        logging.info(f"Reading in notes data file {filepath}")
-        with open(filepath) as f:
-            rawdata = json.load(f)
-            notes_data = list(map(lambda x: dict(x, datetime=dateutil.parser.parse(x['date'])), rawdata))
-            notes_data = list(map(lambda x: dict(x, timestamp=x['datetime'].timestamp()), notes_data))
-            config.notes = notes_data
 
+def only_glucose_readings(chunks):
+    """
+    Passes on just the rows of each chunk that have a glucose reading.
+    """
+    for chunk in chunks:
+        valid = chunk['glucose'] != GLUCOSE_MISSING
+        yield {name: column[valid] for name, column in chunk.items()}
 
-    # merge notes from CGM data into notes data
-    for time, record in data.items():
-        if record['notes'] is not None and len(record['notes']) > 0:
-            dt = dateutil.parser.parse(record['timestamp'])
-            note = dict()
-            note['datetime'] = dt
-            note['date'] = str(dt)
-            note['timestamp'] = dt.timestamp()
-            note['text'] = record['notes']
-            config.notes.append(note)
 
-    current_datetime = datetime.datetime.now()
-    timestr = date_to_output(current_datetime)
-    # TODO: move this into args code
-    reports_dir = os.path.join(os.getcwd(), "reports", timestr)
-    logging.info(f"Generating reports for {timestr}, will store to {reports_dir}")
-    os.makedirs(reports_dir, exist_ok=True)
+def concatenate_chunks(chunks):
+    """
+    Joins chunks of ROW_COLUMNS into one set of columns.
+    """
+    chunks = list(chunks)
+    return {
+        name: np.concatenate([chunk[name] for chunk in chunks]) if chunks else np.zeros(0, dtype=dtype)
+        for name, dtype in (('time', np.int64), ('glucose', np.int16), ('type', np.int8), ('sn', np.int32))
+    }
 
-    config.reports_dir = reports_dir
 
-    # do stuff in parallel
-    return_values = []
-    with concurrent.futures.ProcessPoolExecutor(max_workers=8) as executor:
+def load_cgm_data(filepaths, cache=None):
+    """
+    Reads all the given libreview exports and returns the columnar dataset,
+    sorted by time:
+        'time': int64 epoch seconds
+        'glucose': int16 mg/dL (or GLUCOSE_MISSING)
+        'type': int8 record type
+        'sn': int32 index into 'serials'
+        'serials': list of device serial numbers
+        'note_time': int64 epoch seconds of each note
+        'note_text': list of note text, parallel to note_time
+
+    Exports that overlap are merged, see dedupe_cgm_rows() for what happens
+    to records that show up more than once.
+
+    If a ParseCache is given, files that were parsed before are loaded from it.
+    """
+    serial_codes = {}
+    note_time = []
+    note_text = []
+    data = concatenate_chunks(collect_notes(iter_cgm_data(filepaths, serial_codes, cache), note_time, note_text))
+    data['serials'] = list(serial_codes)
+    data['note_time'] = np.array(note_time, dtype=np.int64)
+    data['note_text'] = note_text
+    logging.debug(f"Merged {len(filepaths)} file(s) into {len(data['time'])} rows")
+    return data
+
+
+def stream_cgm_data(filepaths, tz_min, tz_max, max_gap=None):
+    """
+    Like load_cgm_data(), but in one streaming pass: rows go from the csv
+    files through the merge, have their notes taken out and everything
+    without a glucose reading dropped, then feed the time in target index
+    on their way into the dataset.  Only the readings are kept, so memory
+    is bounded by what the graphs draw rather than by the size of the
+    exports.
+
+    The returned dataset has the index for tz_min/tz_max/max_gap already in
+    it.
+    """
+    serial_codes = {}
+    note_time = []
+    note_text = []
+    tz_index = TimeInTargetIndexBuilder(tz_min, tz_max, max_gap)
+
+    def index_readings(chunks):
+        for chunk in chunks:
+            tz_index.add(chunk['time'], chunk['glucose'])
+            yield chunk
+
+    chunks = iter_cgm_data(filepaths, serial_codes, streaming=True)
+    data = concatenate_chunks(index_readings(only_glucose_readings(collect_notes(chunks, note_time, note_text))))
+    data['serials'] = list(serial_codes)
+    data['note_time'] = np.array(note_time, dtype=np.int64)
+    data['note_text'] = note_text
+    data['tz_index'] = tz_index.finish()
+    data['tz_index']['thresholds'] = (float(tz_min), float(tz_max), max_gap)
+    logging.debug(f"Streamed {len(filepaths)} file(s) into {len(data['time'])} readings")
+    return data
+
+
+def find_cgm_files(paths):
+    """
+    Returns the CGM data files for the given paths: files as they are, and
+    every .csv file in directories, in name order.
+    """
+    filepaths = []
+    for path in paths:
+        if os.path.isdir(path):
+            filepaths.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.lower().endswith(".csv")))
+        else:
+            filepaths.append(path)
+    return filepaths
+
+
+def read_cgm_tail(filepath, offset, serial_codes):
+    """
+    Reads the rows written to a libreview export since byte offset (0 for a
+    file that hasn't been read yet), leaving any half-written last line for
+    next time.  Serial numbers are numbered in serial_codes.
+
+    Returns (columns, new offset, size), columns as from sort_cgm_chunks()
+    and size how much of the file there was to read, half-written line and
+    all.
+    """
+    with open(filepath, 'rb') as f:
+        f.seek(offset)
+        added = f.read()
+    complete = added.rfind(b'\n') + 1
+    lines = io.StringIO(added[:complete].decode())
+    if offset == 0:
+        # the two header lines, wait for both to be there
+        if added[:complete].count(b'\n') < 2:
+            return sort_cgm_chunks([]), 0, len(added)
+        lines.readline()
+        lines.readline()
+    columns = sort_cgm_chunks(parse_cgm_chunks(lines, serial_codes))
+    logging.debug(f"Read {len(columns['time'])} new rows from {filepath}")
+    return columns, offset + complete, offset + len(added)
+
+
+def merge_new_cgm_rows(data, columns, readings_only=False):
+    """
+    Returns the dataset with the rows of columns (as from read_cgm_tail(),
+    with 'sn' numbered like the dataset's) merged in, de-duplicated the
+    same way as loading does.  Only the rows from the first new timestamp
+    on are merged again, the rest of the dataset is reused as is.  With
+    readings_only, rows without a glucose reading are dropped like
+    stream_cgm_data() does.
+    """
+    if len(columns['time']) == 0:
+        return data
+    start = int(np.searchsorted(data['time'], columns['time'].min(), side='left'))
+    tail = {name: data[name][start:] for name in ROW_COLUMNS}
+    tail['notes'] = {}
+    note_time = []
+    note_text = []
+
+    def drop_file(chunks):
+        for chunk in chunks:
+            del chunk['file']
+            yield chunk
+
+    chunks = collect_notes(drop_file(merge_cgm_chunks([iter_cgm_file_chunks(tail, 0), iter_cgm_file_chunks(columns, 1)])), note_time, note_text)
+    if readings_only:
+        chunks = only_glucose_readings(chunks)
+    merged = concatenate_chunks(chunks)
+
+    data = dict(data)
+    for name in ROW_COLUMNS:
+        data[name] = np.concatenate([data[name][:start], merged[name]])
+    # rows read again (e.g. a file that was rewritten) must not repeat notes
+    known = set(zip(data['note_time'].tolist(), data['note_text']))
+    notes = sorted(set(zip(note_time, note_text)) - known)
+    if notes:
+        note_time = np.concatenate([data['note_time'], [when for when, text in notes]]).astype(np.int64)
+        note_text = data['note_text'] + [text for when, text in notes]
+        order = np.argsort(note_time, kind='stable')
+        data['note_time'] = note_time[order]
+        data['note_text'] = [note_text[idx] for idx in order]
+    data.pop('tz_index', None)
+    return data
+
+
+class CgmWatcher:
+    """
+    Keeps a dataset up to date with the CGM data files it was loaded from:
+    rows appended to a file, and new files in watched directories, are read
+    and merged in without reading everything again.  The time in target
+    index is extended the same way when the new readings come after the
+    ones it has already seen.
+    """
+    def __init__(self, paths):
+        self.paths = paths
+        # how many bytes of each file are in the dataset
+        self.offsets = {}
+        # how big each file was when it was last read, which is more than its
+        # offset while the last line is still being written
+        self.sizes = {}
+        self.tz_index = None
+        # how many rows at the start of the dataset no update has touched
+        # since the index was last brought up to date
+        self.unchanged_rows = None
+
+    def start(self):
+        """
+        Remembers how big every file is, call this right before loading the
+        dataset.  Rows written while it loads get read again by the next
+        update() and de-duplicated away.
+        """
+        self.offsets = {filepath: os.path.getsize(filepath) for filepath in find_cgm_files(self.paths)}
+        self.sizes = dict(self.offsets)
+
+    def changed_files(self):
+        """
+        Returns the files that grew or appeared since they were last read,
+        or None if one shrank or went away and the data needs reloading.
+        """
+        filepaths = find_cgm_files(self.paths)
+        if any(filepath not in filepaths for filepath in self.offsets):
+            return None
+        changed = []
+        for filepath in filepaths:
+            size = os.path.getsize(filepath)
+            if size < self.sizes.get(filepath, 0):
+                return None
+            if size > self.sizes.get(filepath, 0):
+                changed.append(filepath)
+        return changed
+
+    def update(self, data, filepaths, readings_only=False):
+        """
+        Returns the dataset with whatever was added to the given files merged in.
+        """
+        serial_codes = {serial: idx for idx, serial in enumerate(data['serials'])}
+        for filepath in filepaths:
+            columns, self.offsets[filepath], self.sizes[filepath] = read_cgm_tail(filepath, self.offsets.get(filepath, 0), serial_codes)
+            if len(columns['time']):
+                start = int(np.searchsorted(data['time'], columns['time'].min(), side='left'))
+                self.unchanged_rows = start if self.unchanged_rows is None else min(self.unchanged_rows, start)
+            data = merge_new_cgm_rows(data, columns, readings_only)
+        data['serials'] = list(serial_codes)
+        return data
+
+    def time_in_target_index(self, config, data):
+        """
+        Returns the time in target index for the dataset (and keeps it on the
+        data like get_time_in_target_index()), only adding the readings it
+        hasn't seen if the earlier ones haven't changed.
+        """
+        key = time_in_target_key(config)
+        valid = data['glucose'] != GLUCOSE_MISSING
+        time_data = data['time'][valid]
+        glucose = data['glucose'][valid]
+        builder = self.tz_index
+        unchanged = len(time_data) if self.unchanged_rows is None else np.count_nonzero(valid[:self.unchanged_rows])
+        if builder is None or (builder.tz_min, builder.tz_max, builder.max_gap) != key or builder.readings > unchanged:
+            builder = self.tz_index = TimeInTargetIndexBuilder(*key)
+        builder.add(time_data[builder.readings:], glucose[builder.readings:])
+        self.unchanged_rows = None
+        data['tz_index'] = builder.finish()
+        data['tz_index']['thresholds'] = key
+        return data['tz_index']
+
+
+class ParseCache:
+    """
+    On-disk cache of parsed input files, so unchanged exports don't get
+    parsed again on every run.
+
+    Entries are keyed by the sha256 of the file contents.  manifest.json
+    remembers the size, mtime and hash last seen for each input path, so
+    files that haven't been touched don't even need to be re-hashed.
+    """
+    def __init__(self, cache_dir, rebuild=False):
+        self.cache_dir = cache_dir
+        # ignore (and overwrite) whatever is there
+        self.rebuild = rebuild
+        os.makedirs(cache_dir, exist_ok=True)
+        self.manifest_file = os.path.join(cache_dir, "manifest.json")
+        self.manifest = {}
+        if os.path.exists(self.manifest_file):
+            try:
+                with open(self.manifest_file) as f:
+                    self.manifest = json.load(f)
+            except (OSError, ValueError):
+                logging.warning(f"Ignoring unreadable parse cache manifest {self.manifest_file}")
+
+    def fingerprint(self, filepath):
+        """
+        Returns the content hash of the file, reusing the manifest's if the
+        size and mtime haven't changed.
+        """
+        filepath = os.path.abspath(filepath)
+        stat = os.stat(filepath)
+        entry = self.manifest.get(filepath)
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['sha256']
+        sha256 = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha256.update(block)
+        self.manifest[filepath] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256.hexdigest()}
+        return sha256.hexdigest()
+
+    def entry_path(self, filepath, suffix):
+        return os.path.join(self.cache_dir, f"{self.fingerprint(filepath)}-v{PARSE_CACHE_VERSION}{suffix}")
+
+    def get_or_parse(self, filepath, suffix, parse, save, load):
+        """
+        Returns load(entry) if there is a cache entry for the file, otherwise
+        parses it with parse(filepath) and stores the result with
+        save(entry, value).
+        """
+        entry = self.entry_path(filepath, suffix)
+        if not self.rebuild and os.path.exists(entry):
+            try:
+                value = load(entry)
+                logging.debug(f"Loaded {filepath} from parse cache {entry}")
+                return value
+            except (OSError, ValueError, KeyError):
+                logging.warning(f"Ignoring unreadable parse cache entry {entry}")
+        value = parse(filepath)
+        # write then rename so a crash never leaves half an entry behind
+        temp = f"{entry}.{os.getpid()}.tmp"
+        save(temp, value)
+        os.replace(temp, entry)
+        return value
+
+    def save(self):
+        """
+        Writes the manifest back out, forgetting input files that no longer
+        exist and deleting entries nothing points at anymore.
+        """
+        self.manifest = {path: entry for path, entry in self.manifest.items() if os.path.exists(path)}
+        live = set(entry['sha256'] for entry in self.manifest.values())
+        for filename in os.listdir(self.cache_dir):
+            if filename == "manifest.json":
+                continue
+            if filename.split("-")[0] not in live or f"-v{PARSE_CACHE_VERSION}." not in filename:
+                logging.debug(f"Evicting stale parse cache entry {filename}")
+                os.remove(os.path.join(self.cache_dir, filename))
+        temp = f"{self.manifest_file}.{os.getpid()}.tmp"
+        with open(temp, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(temp, self.manifest_file)
+
+
+def default_cache_dir():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser("~/.cache"), "glucose-tools")
+
+
+def save_cgm_file(path, columns):
+    notes = sorted(columns['notes'].items())
+    with open(path, 'wb') as f:
+        np.savez(
+            f,
+            time=columns['time'],
+            glucose=columns['glucose'],
+            type=columns['type'],
+            sn=columns['sn'],
+            serials=np.array(columns['serials'], dtype=str),
+            note_rows=np.array([idx for idx, text in notes], dtype=np.int64),
+            note_text=np.array([text for idx, text in notes], dtype=str),
+        )
+
+
+def load_cgm_file(path):
+    with np.load(path, allow_pickle=False) as f:
+        return {
+            'time': f['time'],
+            'glucose': f['glucose'],
+            'type': f['type'],
+            'sn': f['sn'],
+            'serials': f['serials'].tolist(),
+            'notes': dict(zip(f['note_rows'].tolist(), f['note_text'].tolist())),
+        }
+
+
+class CgmStore:
+    """
+    SQLite database of all the CGM history imported into it, for --store.
+    Exports only need importing once: readings and notes are added to what
+    is already there, and records the store already has (the same serial
+    number, timestamp and record type) are left as they were.  Only rows with
+    a glucose reading are kept, like --streaming.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS serials (id INTEGER PRIMARY KEY, serial TEXT NOT NULL UNIQUE);
+        CREATE TABLE IF NOT EXISTS readings (
+            time INTEGER NOT NULL, sn INTEGER NOT NULL, type INTEGER NOT NULL, glucose INTEGER NOT NULL,
+            PRIMARY KEY (time, sn, type)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS notes (time INTEGER NOT NULL, text TEXT NOT NULL, PRIMARY KEY (time, text)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS imports (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, rows INTEGER NOT NULL);
+    """
 
-        return_values.append(executor.submit(generate_weekly_reports, config, data))
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(self.SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def import_cgm_files(self, filepaths):
+        """
+        Adds the readings and notes from the given libreview exports, a
+        chunk at a time and all in one transaction.  Files that haven't
+        changed (same size and mtime) since they were last imported are
+        skipped.
+
+        Returns how many new readings were added.
+        """
+        added = 0
+        with self.connection:
+            serial_ids = dict(self.connection.execute("SELECT serial, id FROM serials"))
+            for filepath in filepaths:
+                filepath = os.path.abspath(filepath)
+                stat = os.stat(filepath)
+                if self.connection.execute("SELECT 1 FROM imports WHERE path = ? AND size = ? AND mtime_ns = ?", (filepath, stat.st_size, stat.st_mtime_ns)).fetchone():
+                    logging.debug(f"{filepath} is already in {self.path}")
+                    continue
+                logging.info(f"Importing CGM data file {filepath} into {self.path}")
+                serial_codes = {}
+                file_added = 0
+                for chunk in iter_cgm_csv_chunks(filepath, serial_codes):
+                    for serial in serial_codes:
+                        if serial not in serial_ids:
+                            serial_ids[serial] = len(serial_ids)
+                            self.connection.execute("INSERT INTO serials (id, serial) VALUES (?, ?)", (serial_ids[serial], serial))
+                    # serial numbers are numbered per file, renumber them for the store
+                    codes = np.array([serial_ids[serial] for serial in serial_codes], dtype=np.int64)
+                    has_note = chunk['note'] != None  # noqa: E711
+                    self.connection.executemany("INSERT OR IGNORE INTO notes (time, text) VALUES (?, ?)",
+                        zip(chunk['time'][has_note].tolist(), chunk['note'][has_note].tolist()))
+                    valid = chunk['glucose'] != GLUCOSE_MISSING
+                    file_added += self.connection.executemany("INSERT OR IGNORE INTO readings (time, sn, type, glucose) VALUES (?, ?, ?, ?)",
+                        zip(chunk['time'][valid].tolist(), codes[chunk['sn'][valid]].tolist(), chunk['type'][valid].tolist(), chunk['glucose'][valid].tolist())).rowcount
+                self.connection.execute("INSERT OR REPLACE INTO imports (path, size, mtime_ns, rows) VALUES (?, ?, ?, ?)", (filepath, stat.st_size, stat.st_mtime_ns, file_added))
+                added += file_added
+        return added
+
+    def load_cgm_data(self):
+        """
+        Returns the dataset (see load_cgm_data()) of everything in the store.
+        Where records have a reading at the same minute, the glucose goes by
+        GLUCOSE_PRECEDENCE like when merging exports, see dedupe_cgm_rows().
+        """
+        rows = self.connection.execute("SELECT time, glucose, type, sn FROM readings ORDER BY time, sn, type").fetchall()
+        columns = np.array(rows, dtype=np.int64).reshape(-1, 4)
+        data = dedupe_cgm_rows({
+            'time': columns[:, 0],
+            'glucose': columns[:, 1].astype(np.int16),
+            'type': columns[:, 2].astype(np.int8),
+            'sn': columns[:, 3].astype(np.int32),
+            'file': np.zeros(len(columns), dtype=np.int32),
+        })
+        del data['file']
+        valid = data['glucose'] != GLUCOSE_MISSING
+        data = {name: data[name][valid] for name in ROW_COLUMNS}
+        data['serials'] = [serial for (serial,) in self.connection.execute("SELECT serial FROM serials ORDER BY id")]
+        notes = self.connection.execute("SELECT time, text FROM notes ORDER BY time, text").fetchall()
+        data['note_time'] = np.array([when for when, text in notes], dtype=np.int64)
+        data['note_text'] = [text for when, text in notes]
+        logging.debug(f"Loaded {len(data['time'])} readings from {self.path}")
+        return data
+
+
+class SharedDataset:
+    """
+    Small, picklable handle for a dataset published with publish_dataset().
+    This is what gets sent to worker processes instead of the data itself.
+    """
+    def __init__(self, name, columns, objects, row_range=None):
+        # name of the shared memory block
+        self.name = name
+        # list of (key, dtype, shape, offset) for each array in the block
+        self.columns = columns
+        # everything that isn't an array, small enough to just pickle
+        self.objects = objects
+        # (start, end) of the ROW_COLUMNS rows this task should see, or None
+        self.row_range = row_range
+
+    def __repr__(self):
+        return f"SharedDataset({self.name}, {len(self.columns)} columns, rows {self.row_range})"
+
+    def rows(self, start_idx, end_idx):
+        """
+        Returns a descriptor for just rows [start_idx, end_idx) of the dataset.
+        """
+        return SharedDataset(self.name, self.columns, self.objects, (start_idx, end_idx))
+
+
+def slice_dataset(data, start_idx, end_idx):
+    """
+    Returns a shallow copy of the dataset with the ROW_COLUMNS cut down to
+    rows [start_idx, end_idx).  The slices are views, nothing is copied.
+    """
+    data = dict(data)
+    for key in ROW_COLUMNS:
+        data[key] = data[key][start_idx:end_idx]
+    return data
 
-        # all time graphs
-        return_values.append(executor.submit(generate_all_time_glucose_plot, os.path.join(reports_dir, "all-time-glucose-graph.png"), config, data))
-        return_values.append(executor.submit(generate_all_time_tz_plot, os.path.join(reports_dir, "all-time-tz-graph.png"), config, data))
-        return_values.append(executor.submit(generate_weekly_tz_plot, os.path.join(reports_dir, "all-time-weeklytz-graph.png"), config, data))
 
-        # last year graphs
-        return_values.append(executor.submit(generate_time_range_glucose_report, os.path.join(reports_dir, "last-year-glucose-graph.png"), "Last Year Glucose Levels Report", config, data, (current_datetime - datetime.timedelta(weeks=52)), current_datetime))
-        return_values.append(executor.submit(generate_time_range_tz_report, os.path.join(reports_dir, "last-year-tz-graph.png"), "Last Year Daily Time Spent In Zone Report", config, data, (current_datetime - datetime.timedelta(weeks=52)), current_datetime))
-        return_values.append(executor.submit(generate_time_range_weekly_tz_report, os.path.join(reports_dir, "last-year-weeklytz-graph.png"), "Last Year Weekly Time Spent In Zone Report", config, data, (current_datetime - datetime.timedelta(weeks=52)), current_datetime))
+def dataset_rows_between(data, start_date, end_date):
+    """
+    Returns (start_idx, end_idx) of the rows between start_date and end_date,
+    inclusive, the same way graphify_glucose_data() filters.
+    """
+    return (
+        int(np.searchsorted(data['time'], datetime_to_epoch(start_date), side='left')),
+        int(np.searchsorted(data['time'], datetime_to_epoch(end_date), side='right')),
+    )
 
-        # last 6mo graphs
-        return_values.append(executor.submit(generate_time_range_glucose_report, os.path.join(reports_dir, "last-6mo-glucose-graph.png"), "Last Six Month Glucose Levels Report", config, data, (current_datetime - datetime.timedelta(weeks=26)), current_datetime))
-        return_values.append(executor.submit(generate_time_range_tz_report, os.path.join(reports_dir, "last-6mo-tz-graph.png"), "Last Six Month Daily Time Spent In Zone Report", config, data, (current_datetime - datetime.timedelta(weeks=26)), current_datetime))
-        return_values.append(executor.submit(generate_time_range_weekly_tz_report, os.path.join(reports_dir, "last-6mo-weeklytz-graph.png"), "Last Six Month Weekly Time Spent In Zone Report", config, data, (current_datetime - datetime.timedelta(weeks=26)), current_datetime))
 
-    sys.exit(0)
+def dataset_time_window(data, start_date=None, end_date=None):
+    """
+    Returns (first, last) epoch seconds of the rows between start_date and
+    end_date (see dataset_rows_between()), or of every row without them, or
+    None if there aren't any.  The notes in it are the ones a graph of those
+    rows draws, see report_fingerprint().
+    """
+    start_idx, end_idx = dataset_rows_between(data, start_date, end_date) if start_date is not None else (0, len(data['time']))
+    if end_idx <= start_idx:
+        return None
+    return (int(data['time'][start_idx]), int(data['time'][end_idx - 1]))
+
+
+def publish_dataset(data):
+    """
+    Copies every array in the dataset (including nested dicts like the time
+    in target index) into one shared memory block so worker processes can
+    attach to it without copying.
+
+    Returns (shm, descriptor).  The caller owns shm and must close() and
+    unlink() it once the workers are done.
+    """
+    columns = []
+    objects = {}
+    offset = 0
+
+    def layout(prefix, values):
+        nonlocal offset
+        for key, value in values.items():
+            path = prefix + (key,)
+            if isinstance(value, dict):
+                layout(path, value)
+            elif isinstance(value, np.ndarray) and value.dtype != object:
+                offset = -(-offset // SHARED_COLUMN_ALIGNMENT) * SHARED_COLUMN_ALIGNMENT
+                columns.append((path, value.dtype.str, value.shape, offset))
+                offset += value.nbytes
+            else:
+                objects[path] = value
+    layout((), data)
+
+    import multiprocessing.shared_memory
+    shm = multiprocessing.shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for path, dtype, shape, column_offset in columns:
+        value = data
+        for key in path:
+            value = value[key]
+        np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=column_offset)[...] = value
+    logging.debug(f"Published {len(columns)} columns ({offset} bytes) to shared memory {shm.name}")
+    return shm, SharedDataset(shm.name, columns, objects)
+
+
+# shared memory blocks this process has attached to, by name
+_attached_datasets = {}
+
+
+def attach_dataset(descriptor):
+    """
+    Returns the dataset for a SharedDataset descriptor.  Arrays are read-only
+    views into the shared memory block, so nothing is copied.  Each process
+    only attaches once per block.
+    """
+    if descriptor.name not in _attached_datasets:
+        # let go of the oldest datasets (--watch publishes a new one for
+        # every update, --batch one per patient), unless something still has
+        # a view of it
+        for name in list(_attached_datasets)[:max(len(_attached_datasets) - BATCH_PATIENTS_IN_FLIGHT + 1, 0)]:
+            old_shm, old_data = _attached_datasets.pop(name)
+            del old_data
+            try:
+                old_shm.close()
+            except BufferError:
+                pass
+        import multiprocessing.shared_memory
+        shm = multiprocessing.shared_memory.SharedMemory(name=descriptor.name)
+        data = {}
+
+        def store(path, value):
+            target = data
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = value
+
+        for path, dtype, shape, offset in descriptor.columns:
+            column = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+            column.flags.writeable = False
+            store(path, column)
+        for path, value in descriptor.objects.items():
+            store(path, value)
+        _attached_datasets[descriptor.name] = (shm, data)
+    data = _attached_datasets[descriptor.name][1]
+    if descriptor.row_range is not None:
+        data = slice_dataset(data, *descriptor.row_range)
+    return data
+
+
+def run_with_dataset(function, *args):
+    """
+    Runs function(*args) in a worker, swapping any SharedDataset arguments
+    for the attached dataset.
+    """
+    args = [attach_dataset(arg) if isinstance(arg, SharedDataset) else arg for arg in args]
+    return function(*args)
+
+
+# timing spans recorded in this process, see timed()
+_spans = []
+
+
+@contextlib.contextmanager
+def timed(name, **details):
+    """
+    Records how long the enclosed block took (wall and cpu time) and the
+    peak RSS of this process by the end of it, as a span in _spans.
+    """
+    start = time.time()
+    start_perf = time.perf_counter()
+    start_cpu = time.process_time()
+    try:
+        yield
+    finally:
+        span = {
+            'name': name,
+            'pid': os.getpid(),
+            'start': start,
+            'seconds': time.perf_counter() - start_perf,
+            'cpu_seconds': time.process_time() - start_cpu,
+            # ru_maxrss is in kilobytes on linux
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        }
+        span.update(details)
+        _spans.append(span)
+
+
+def run_instrumented(name, profile_file, function, *args):
+    """
+    Worker side of a report task: runs run_with_dataset(function, *args)
+    inside a span, optionally under cProfile (dumped to profile_file).
+
+    Returns (result, spans) where spans are everything recorded in this
+    worker while the task ran.
+    """
+    del _spans[:]
+    profiler = None
+    if profile_file:
+        import cProfile
+        profiler = cProfile.Profile()
+    with timed('task', task=name):
+        if profiler:
+            profiler.enable()
+        try:
+            result = run_with_dataset(function, *args)
+        finally:
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(profile_file)
+    spans = list(_spans)
+    del _spans[:]
+    return result, spans
+
+
+def summarize_spans(spans):
+    """
+    Returns {name: {count, seconds, cpu_seconds, max_seconds, peak_rss_mb}}
+    over a list of spans.
+    """
+    summary = {}
+    for span in spans:
+        entry = summary.setdefault(span['name'], {'count': 0, 'seconds': 0.0, 'cpu_seconds': 0.0, 'max_seconds': 0.0, 'peak_rss_mb': 0.0})
+        entry['count'] += 1
+        entry['seconds'] += span['seconds']
+        entry['cpu_seconds'] += span['cpu_seconds']
+        entry['max_seconds'] = max(entry['max_seconds'], span['seconds'])
+        entry['peak_rss_mb'] = max(entry['peak_rss_mb'], span['peak_rss_mb'])
+    return summary
+
+
+def read_notes_file(filepath):
+    """
+    Reads a notes json file (see the README for the format), adding the
+    parsed 'datetime' and 'timestamp' to each note.
+    """
+    import dateutil.parser
+    with open(filepath) as f:
+        rawdata = json.load(f)
+        notes_data = list(map(lambda x: dict(x, datetime=dateutil.parser.parse(x['date'])), rawdata))
+        notes_data = list(map(lambda x: dict(x, timestamp=x['datetime'].timestamp()), notes_data))
+    return notes_data
+
+
+def save_notes_file(path, notes_data):
+    with open(path, 'w') as f:
+        json.dump([dict(note, datetime=note['datetime'].isoformat()) for note in notes_data], f)
+
+
+def load_notes_file(path):
+    with open(path) as f:
+        return [dict(note, datetime=datetime.datetime.fromisoformat(note['datetime'])) for note in json.load(f)]
+
+
+def load_notes_data(filepaths, cache=None):
+    """
+    Reads all the given notes files, returns the list of notes.
+    """
+    notes = []
+    for filepath in filepaths:
+        logging.info(f"Reading in notes data file {filepath}")
+        if cache is None:
+            notes.extend(read_notes_file(filepath))
+        else:
+            notes.extend(cache.get_or_parse(filepath, ".notes.json", read_notes_file, save_notes_file, load_notes_file))
+    return notes
+
+
+class ReportTask:
+    """
+    One graph to generate: output_file = function(*args), where the DATASET
+    marker in args is replaced by the data (or a handle to it) when the task
+    runs.  rows is the (start, end) range of rows the graph looks at, or None
+    for all of them.
+
+    For estimate_report_cost(): interval is the bucket size of a time in
+    zone graph (None for graphs that plot readings), and annotated is
+    whether notes get drawn on the graph.
+    """
+    def __init__(self, output_file, function, args, rows=None, interval=None, annotated=True):
+        self.output_file = output_file
+        self.function = function
+        self.args = args
+        self.rows = rows
+        self.interval = interval
+        self.annotated = annotated
+
+    def bind(self, dataset):
+        """
+        Returns the args with the dataset filled in, cut down to our rows if
+        the dataset is a SharedDataset.
+        """
+        if self.rows is not None and isinstance(dataset, SharedDataset):
+            dataset = dataset.rows(*self.rows)
+        return [dataset if arg is DATASET else arg for arg in self.args]
 
 
-@memoization.cached
-def calculate_time_glucose_transitions(time_a, glucose_a, target_glucose, time_b, glucose_b):
+# placeholder for the dataset in ReportTask args
+DATASET = object()
+
+
+def plan_reports(config, data, current_datetime):
+    """
+    Returns the list of ReportTasks for a full set of reports.
     """
-    Calculates the approximate time between two points the glucose level hits a
-    certain value via linear extrapolation.
+    reports_dir = config.reports_dir
+    tasks = []
+
+    # weekly graphs, each task only gets its own week of data
+    for output_file, title, start_date in plan_weekly_reports(config, data):
+        rows = dataset_rows_between(data, start_date, start_date + datetime.timedelta(weeks=1))
+        tasks.append(ReportTask(output_file, generate_one_week_report, [output_file, title, config, DATASET, start_date], rows))
+
+    # all time graphs
+    day = datetime.timedelta(days=1)
+    week = datetime.timedelta(weeks=1)
+    for filename, function, interval in (
+            ("all-time-glucose-graph.png", generate_all_time_glucose_plot, None),
+            ("all-time-tz-graph.png", generate_all_time_tz_plot, day),
+            ("all-time-weeklytz-graph.png", generate_weekly_tz_plot, week)):
+        output_file = os.path.join(reports_dir, filename)
+        tasks.append(ReportTask(output_file, function, [output_file, config, DATASET], interval=interval))
+    output_file = os.path.join(reports_dir, "all-time-agp-graph.png")
+    tasks.append(ReportTask(output_file, generate_all_time_agp_plot, [output_file, config, DATASET], annotated=False))
+
+    # last year and last 6mo graphs
+    for prefix, name, weeks in (("last-year", "Last Year", 52), ("last-6mo", "Last Six Month", 26)):
+        start_date = current_datetime - datetime.timedelta(weeks=weeks)
+        rows = dataset_rows_between(data, start_date, current_datetime)
+        for suffix, title, function, interval in (
+                ("glucose-graph.png", "Glucose Levels Report", generate_time_range_glucose_report, None),
+                ("tz-graph.png", "Daily Time Spent In Zone Report", generate_time_range_tz_report, day),
+                ("weeklytz-graph.png", "Weekly Time Spent In Zone Report", generate_time_range_weekly_tz_report, week)):
+            output_file = os.path.join(reports_dir, f"{prefix}-{suffix}")
+            tasks.append(ReportTask(output_file, function, [output_file, f"{name} {title}", config, DATASET, start_date, current_datetime], rows, interval))
+        output_file = os.path.join(reports_dir, f"{prefix}-agp-graph.png")
+        tasks.append(ReportTask(output_file, generate_time_range_agp_report, [output_file, f"{name} Ambulatory Glucose Profile", config, DATASET, start_date, current_datetime], rows, annotated=False))
+
+    # last 14 days ambulatory glucose profile, the usual window for one
+    start_date = current_datetime - datetime.timedelta(days=14)
+    output_file = os.path.join(reports_dir, "last-14d-agp-graph.png")
+    rows = dataset_rows_between(data, start_date, current_datetime)
+    tasks.append(ReportTask(output_file, generate_time_range_agp_report, [output_file, "Last 14 Day Ambulatory Glucose Profile", config, DATASET, start_date, current_datetime], rows, annotated=False))
+    return tasks
+
+
+def estimate_report_cost(config, data, task):
+    """
+    Returns a rough estimate of how long a ReportTask takes to render, in
+    seconds on one core, from how many rows it reads, how many points or
+    buckets it plots and how many notes it draws (see REPORT_COST_BASE).
+    """
+    start_idx, end_idx = task.rows if task.rows is not None else (0, len(data['time']))
+    rows = end_idx - start_idx
+    if rows <= 0:
+        return REPORT_COST_BASE
+    if task.interval is not None:
+        points = (data['time'][end_idx - 1] - data['time'][start_idx]) / task.interval.total_seconds() + 1
+    else:
+        # long graphs get downsampled, weekly ones are small anyways
+        points = min(rows, 2 * DOWNSAMPLE_BUCKETS)
+    notes = len(config.notes.between(data['time'][start_idx], data['time'][end_idx - 1])) if task.annotated else 0
+    return REPORT_COST_BASE + REPORT_COST_PER_NOTE * notes + REPORT_COST_PER_ROW * rows + REPORT_COST_PER_POINT * points
+
+
+def schedule_reports(config, data, tasks):
+    """
+    Returns the tasks in the order to submit them: most expensive first
+    (see estimate_report_cost()), so the long graphs start right away and
+    the many small ones fill in around them instead of one long graph
+    being left running on its own at the end.
+    """
+    costs = {task.output_file: estimate_report_cost(config, data, task) for task in tasks}
+    ordered = sorted(tasks, key=lambda task: -costs[task.output_file])
+    if ordered:
+        logging.debug(f"Estimated {sum(costs.values()):.1f}s of rendering, longest {os.path.basename(ordered[0].output_file)} at {costs[ordered[0].output_file]:.1f}s")
+    return ordered
 
-    Precondition:  time_a must be before time_b, target_glucose must be between
-    glucose a and glucose_b, or I shall not be held responsible for the
-    results! =)
 
-    # ### test code TODO: test this, but it works!
-    time_a = datetime.datetime.now()
-    time_b = time_a + datetime.timedelta(seconds=100)
+def default_worker_count():
+    """
+    Returns how many CPUs this process may run on.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
 
-    glucose_a = 100
-    glucose_b = 200
 
-    print(f"Result should be {time_a + datetime.timedelta(seconds=20)}: " + str(calculate_time_glucose_transitions(time_a, glucose_a, 120, time_b, glucose_b)))
+def report_fingerprint(config, data, task):
+    """
+    Returns a hash of everything that goes into a graph: the rows it looks
+    at, the notes, the config thresholds and the title.  The start and end
+    dates don't matter on their own, only what data they select.
+    """
+    sha256 = hashlib.sha256()
+    sha256.update(f"v{REPORT_FORMAT_VERSION} {task.function.__name__}".encode())
+    for arg in task.args:
+        if arg is not DATASET and arg != task.output_file and isinstance(arg, (str, int, float)):
+            sha256.update(repr(arg).encode())
+    for key in REPORT_CONFIG_KEYS:
+        sha256.update(repr((key, getattr(config, key, None))).encode())
+    start_idx, end_idx = task.rows if task.rows is not None else (0, len(data['time']))
+    # rows without a reading don't show up in any graph
+    readings = data['glucose'][start_idx:end_idx] != GLUCOSE_MISSING
+    for key in ('time', 'glucose'):
+        sha256.update(np.ascontiguousarray(data[key][start_idx:end_idx][readings]).tobytes())
+    # only notes inside the graph get drawn
+    if end_idx > start_idx:
+        for when, note in config.notes.between(data['time'][start_idx], data['time'][end_idx - 1]):
+            sha256.update(repr((when, note['text'])).encode())
+    return sha256.hexdigest()
+
+
+def find_previous_reports_dir(reports_dir):
+    """
+    Returns the most recent reports dir next to the given one that has a
+    manifest, or None.
+    """
+    parent, current = os.path.split(reports_dir)
+    candidates = sorted(name for name in os.listdir(parent) if name < current)
+    for name in reversed(candidates):
+        if os.path.exists(os.path.join(parent, name, "manifest.json")):
+            return os.path.join(parent, name)
+    return None
 
-    print(f"Result should be {time_a + datetime.timedelta(seconds=45)}: " + str(calculate_time_glucose_transitions(time_a, glucose_a, 145, time_b, glucose_b)))
 
-    print(f"Result should be {time_a + datetime.timedelta(seconds=15)}: " + str(calculate_time_glucose_transitions(time_a, glucose_b, 185, time_b, glucose_a)))
-    # ### end test code
+def carry_report_forward(previous_file, output_file):
+    """
+    Reuses a graph from a previous run, hard linking it if possible.
     """
     try:
-        glucose_range = glucose_b - glucose_a
-        time_delta_to_transition = ((target_glucose - glucose_a) / (glucose_b - glucose_a)) * (time_b - time_a)
-        return time_a + time_delta_to_transition
-    except:
-        # if we get a div by zero or something, just assume it happened at time A
-        # TODO: is this the best option? why is this happening?
-        return time_a
+        os.link(previous_file, output_file)
+    except OSError:
+        shutil.copy2(previous_file, output_file)
 
 
-@memoization.cached
-def calculate_glucose_between_two_times(time_a, glucose_a, target_time, time_b, glucose_b):
+class NotesIndex:
     """
-    Calculates the approximate glucose at a given time between two data
-    points via linear extrapolation.
+    Notes sorted by time, so a graph can find the ones that fall inside it
+    without looking at every note.  Iterating gives the notes in time order.
+    """
+    def __init__(self, notes):
+        # notes are placed by the same wall clock seconds as the readings
+        timed_notes = sorted(((datetime_to_epoch(note['datetime']), note) for note in notes), key=lambda pair: pair[0])
+        self.times = [when for when, note in timed_notes]
+        self.notes = [note for when, note in timed_notes]
 
-    Precondition:  time_a must be before target_time, time_b must be after
-    target_time, or I shall not be held responsible for the results! =)
+    def __len__(self):
+        return len(self.notes)
 
-    TODO: write these as tests?  It works!
-    # #### TEST CODE
-    time_a = datetime.datetime.now()
-    time_b = time_a + datetime.timedelta(days=1)
-    glucose_a = 100
-    glucose_b = 200
+    def __iter__(self):
+        return iter(self.notes)
 
-    target_one = time_a + datetime.timedelta(hours=4)
-    glucose_one = ((200.0-100) * (1.0/6))+100
+    def between(self, start, end):
+        """
+        Returns [(epoch seconds, note)] for the notes from start to end
+        (epoch seconds, inclusive).
+        """
+        first = bisect.bisect_left(self.times, start)
+        last = bisect.bisect_right(self.times, end)
+        return list(zip(self.times[first:last], self.notes[first:last]))
 
-    target_two = time_a + datetime.timedelta(hours=12)
-    glucose_two = 150.0
 
-    backwards_target_three = time_a + datetime.timedelta(hours=4)
-    backwards_glucose_three = ((100.0-200) * (1.0/6))+200
+def notes_with_cgm_notes(notes, data):
+    """
+    Returns a NotesIndex of the notes data plus the notes from the CGM data.
+    """
+    notes = list(notes)
+    # merge notes from CGM data into notes data
+    for ts, text in zip(data['note_time'], data['note_text']):
+        dt = epoch_to_datetime(ts)
+        note = dict()
+        note['datetime'] = dt
+        note['date'] = str(dt)
+        note['timestamp'] = dt.timestamp()
+        note['text'] = text
+        notes.append(note)
+    return NotesIndex(notes)
+
+
+def submit_reports(config, executor, data, shared, pending, profile_dir=None):
+    """
+    Submits the pending ReportTasks to the executor, longest first, with the
+    dataset published as shared.
 
-    result = calculate_glucose_between_two_times(time_a, glucose_a, target_one, time_b, glucose_b)
-    print(f"Expected result {glucose_one}, got {result}")
+    Returns [(task, submit time, future)] for collect_reports().
+    """
+    with timed('schedule_reports'):
+        pending = schedule_reports(config, data, pending)
+    submitted = []
+    for task in pending:
+        name = os.path.basename(task.output_file)
+        profile_file = os.path.join(profile_dir, f"{name}.prof") if profile_dir else None
+        submitted.append((task, time.time(), executor.submit(run_instrumented, name, profile_file, task.function, *task.bind(shared))))
+    return submitted
 
-    result = calculate_glucose_between_two_times(time_a, glucose_a, target_two, time_b, glucose_b)
-    print(f"Expected result {glucose_two}, got {result}")
 
-    result = calculate_glucose_between_two_times(time_a, glucose_b, backwards_target_three, time_b, glucose_a)
-    print(f"Expected result {backwards_glucose_three}, got {result}")
-    # #### END TEST CODE
+def collect_reports(config, data, tasks, submitted, fingerprints, manifest):
+    """
+    Waits for the tasks from submit_reports(), then writes the index and
+    manifest for the full list of tasks.  Graphs that render fine get their
+    fingerprint added to the manifest.
 
+    Returns (task_timings, failures).
+    """
+    import concurrent.futures
+    concurrent.futures.wait([future for task, submit_time, future in submitted])
+    task_timings = []
+    failures = 0
+    for task, submit_time, future in submitted:
+        name = os.path.basename(task.output_file)
+        try:
+            result, spans = future.result()
+        except Exception:
+            failures += 1
+            logging.error(f"Generating {name} failed:\n{traceback.format_exc()}")
+            task_timings.append({'output_file': name, 'status': 'error', 'error': traceback.format_exc()})
+            continue
+        manifest[name] = fingerprints[task.output_file]
+        task_timings.append({
+            'output_file': name,
+            'status': 'ok',
+            # how long the task sat in the queue before a worker started it
+            'queued_seconds': next(span['start'] for span in spans if span['name'] == 'task') - submit_time,
+            'spans': spans,
+        })
+
+    # now that every graph is done, write the index
+    generate_index(config, [task.output_file for task in tasks if task.function is generate_one_week_report])
+    with timed('coverage_report'):
+        with open(os.path.join(config.reports_dir, "coverage.json"), 'w') as f:
+            json.dump(coverage_report(config, data), f, indent=1)
+    with open(os.path.join(config.reports_dir, "manifest.json"), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    return task_timings, failures
+
+
+def render_reports(config, executor, data, tasks, pending, fingerprints, manifest, profile_dir=None):
     """
-    timedelta_before = target_time - time_a
-    timedelta_after = time_b - target_time
+    Renders the pending ReportTasks in the executor's worker processes,
+    then writes the index and manifest for the full list of tasks (see
+    collect_reports()).
 
-    ratio_to_apply = timedelta_before / (timedelta_before + timedelta_after)
-    return glucose_a + ((glucose_b - glucose_a) * ratio_to_apply)
+    Returns (task_timings, failures).
+    """
+    # publish the parsed data once, every task just gets a handle to it
+    with timed('publish_dataset'):
+        shm, shared = publish_dataset(data)
+    try:
+        # do stuff in parallel, collect_reports() waits for all of it
+        with timed('render_reports', tasks=len(pending)):
+            submitted = submit_reports(config, executor, data, shared, pending, profile_dir)
+            return collect_reports(config, data, tasks, submitted, fingerprints, manifest)
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def watch_cgm_data(config, executor, watcher, data, notes, manifest):
+    """
+    Runs until interrupted, checking the CGM data files every
+    config.watch_interval seconds.  New data is merged into the dataset and
+    only the graphs it changes (going by their fingerprints) are rendered
+    again, in place in the reports dir.
+    """
+    logging.info(f"Watching {', '.join(config.cgm_data)} for new CGM data every {config.watch_interval}s")
+    while True:
+        time.sleep(config.watch_interval)
+        changed = watcher.changed_files()
+        if changed == []:
+            continue
+        # only keep the timings of the latest update
+        del _spans[:]
+        update_start = time.perf_counter()
+        if changed is None:
+            logging.info("A CGM data file shrank or went away, reloading everything")
+            watcher = CgmWatcher(config.cgm_data)
+            watcher.start()
+            if config.streaming:
+                data = stream_cgm_data(find_cgm_files(config.cgm_data), config.target_min, config.target_max, max_gap_seconds(config))
+            else:
+                data = load_cgm_data(find_cgm_files(config.cgm_data))
+        else:
+            logging.info(f"New CGM data in {', '.join(changed)}")
+            data = watcher.update(data, changed, readings_only=config.streaming)
+        config.notes = notes_with_cgm_notes(notes, data)
+        watcher.time_in_target_index(config, data)
+
+        tasks = plan_reports(config, data, datetime.datetime.now())
+        fingerprints = {task.output_file: report_fingerprint(config, data, task) for task in tasks}
+        pending = [task for task in tasks if manifest.get(os.path.basename(task.output_file)) != fingerprints[task.output_file]]
+        for task in pending:
+            # may be hard linked to a graph in an earlier reports dir
+            if os.path.exists(task.output_file):
+                os.remove(task.output_file)
+        task_timings, failures = render_reports(config, executor, data, tasks, pending, fingerprints, manifest)
+        if failures:
+            logging.error(f"{failures} of {len(pending)} graphs failed")
+        logging.info(f"Updated {len(pending) - failures} of {len(tasks)} graphs in {time.perf_counter() - update_start:.2f}s")
+
+
+def write_timings(reports_dir, run_start, task_timings, stages=None):
+    """
+    Writes timings.json for the whole run, both in this process (stages,
+    everything recorded here by default) and in the workers, and logs a
+    summary of it.
+    """
+    stages = list(_spans) if stages is None else stages
+    task_spans = [span for timing in task_timings for span in timing.get('spans', [])]
+    timings = {
+        'wall_seconds': time.perf_counter() - run_start,
+        'stages': stages,
+        'tasks': task_timings,
+        'summary': summarize_spans(stages + task_spans),
+    }
+    with open(os.path.join(reports_dir, "timings.json"), 'w') as f:
+        json.dump(timings, f, indent=1)
+    logging.info(f"Finished in {timings['wall_seconds']:.2f}s, timings written to {os.path.join(reports_dir, 'timings.json')}")
+    for name, entry in sorted(timings['summary'].items(), key=lambda item: -item[1]['seconds']):
+        logging.info(f"  {name:<24} {entry['count']:>5}x {entry['seconds']:>9.3f}s total {entry['max_seconds']:>8.3f}s max {entry['peak_rss_mb']:>8.1f}MB peak rss")
+
+
+def load_config_cgm_data(config, cache):
+    """
+    Returns the dataset for config.cgm_data, streamed with --streaming.
+    With --store, the files are imported into the store first and the
+    dataset is everything in it.
+    """
+    cgm_files = find_cgm_files(config.cgm_data or [])
+    if config.store:
+        store = CgmStore(config.store)
+        try:
+            with timed('import_cgm_data', files=len(cgm_files)):
+                added = store.import_cgm_files(cgm_files)
+            logging.info(f"Added {added} new readings to {config.store}")
+            with timed('load_cgm_data'):
+                return store.load_cgm_data()
+        finally:
+            store.close()
+    if config.streaming:
+        with timed('stream_cgm_data', files=len(cgm_files)):
+            return stream_cgm_data(cgm_files, config.target_min, config.target_max, max_gap_seconds(config))
+    with timed('load_cgm_data', files=len(cgm_files)):
+        return load_cgm_data(cgm_files, cache)
+
+
+def prepare_reports(config, cache, reports_dir, current_datetime, watcher=None):
+    """
+    Loads the CGM data and notes for config, makes reports_dir and plans the
+    graphs to go in it.  With --incremental, graphs that haven't changed
+    since the previous run are carried forward right away, and only the
+    rest are pending.  Sets config.notes, config.reports_dir and
+    config.profile_dir.
+
+    Returns (data, notes, tasks, pending, fingerprints, manifest).
+    """
+    # first parse any cgm data
+    data = load_config_cgm_data(config, cache)
+
+    # parse any notes data
+    with timed('load_notes_data'):
+        notes = load_notes_data(config.notes_data or [], cache)
+
+    config.notes = notes_with_cgm_notes(notes, data)
+
+    logging.info(f"Generating reports for {date_to_output(current_datetime)}, will store to {reports_dir}")
+    os.makedirs(reports_dir, exist_ok=True)
+
+    config.reports_dir = reports_dir
+
+    # build the time in target index once so every tz report can share it
+    with timed('time_in_target_index'):
+        if watcher is not None:
+            watcher.time_in_target_index(config, data)
+        else:
+            get_time_in_target_index(config, data)
+
+    with timed('plan_reports'):
+        tasks = plan_reports(config, data, current_datetime)
+        fingerprints = {task.output_file: report_fingerprint(config, data, task) for task in tasks}
+
+    # in incremental mode, graphs whose inputs haven't changed since the last
+    # run are carried forward instead of being rendered again
+    previous_manifest = {}
+    previous_dir = find_previous_reports_dir(reports_dir) if config.incremental else None
+    if previous_dir:
+        with open(os.path.join(previous_dir, "manifest.json")) as f:
+            previous_manifest = json.load(f)
+    manifest = {}
+    pending = []
+    for task in tasks:
+        filename = os.path.basename(task.output_file)
+        previous_file = os.path.join(previous_dir, filename) if previous_dir else None
+        if previous_manifest.get(filename) == fingerprints[task.output_file] and os.path.exists(previous_file):
+            carry_report_forward(previous_file, task.output_file)
+            manifest[filename] = fingerprints[task.output_file]
+        else:
+            pending.append(task)
+    if previous_dir:
+        logging.info(f"Reusing {len(tasks) - len(pending)} unchanged graphs from {previous_dir}, rendering {len(pending)}")
+
+    config.profile_dir = None
+    if config.profile:
+        config.profile_dir = os.path.join(reports_dir, "profiles")
+        os.makedirs(config.profile_dir, exist_ok=True)
+    return data, notes, tasks, pending, fingerprints, manifest
+
+
+def parse_report_options(options, source):
+    """
+    Returns the report options (see REPORT_CONFIG_KEYS) in the options dict
+    converted with the types and choices of the matching command line
+    options, so a patient can't set anything the command line wouldn't
+    take.  Raises ValueError naming source for unknown or invalid options.
+    """
+    if not isinstance(options, dict):
+        raise ValueError(f"{source} must hold an object of settings, got {options!r}")
+    actions = {action.dest: action for action in build_arg_parser()._actions}
+    unknown = sorted(set(options) - set(REPORT_CONFIG_KEYS))
+    if unknown:
+        raise ValueError(f"{source} has unknown settings {', '.join(unknown)}")
+    parsed = {}
+    for key, value in options.items():
+        action = actions[key]
+        if action.type is None:
+            # flags like --full-resolution
+            if not isinstance(value, bool):
+                raise ValueError(f"{source}: {key} must be true or false, got {value!r}")
+        else:
+            # the command line only ever hands over strings
+            if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+                raise ValueError(f"{source}: {key} isn't a valid {action.type.__name__}: {value!r}")
+            try:
+                value = action.type(str(value))
+            except ValueError:
+                raise ValueError(f"{source}: {key} isn't a valid {action.type.__name__}: {value!r}") from None
+            if action.choices is not None and value not in action.choices:
+                raise ValueError(f"{source}: {key} must be one of {', '.join(map(str, action.choices))}, got {value!r}")
+        parsed[key] = value
+    return parsed
+
+
+def load_batch_patients(path):
+    """
+    Returns the patients for --batch, as a list of dicts with their name,
+    cgm_data and notes_data paths and any report options to override (see
+    BATCH_PATIENT_KEYS).
+
+    path is either a JSON manifest holding that list, with paths relative
+    to the manifest, or a directory with one subdirectory per patient.  Each
+    subdirectory holds the patient's CSV exports, optionally their notes in
+    notes.json and their overrides in config.json.
+    """
+    patients = []
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            patient_dir = os.path.join(path, name)
+            if not os.path.isdir(patient_dir):
+                continue
+            patient = {}
+            config_file = os.path.join(patient_dir, "config.json")
+            if os.path.exists(config_file):
+                with open(config_file) as f:
+                    patient = parse_report_options(json.load(f), config_file)
+            patient['name'] = name
+            patient['cgm_data'] = [patient_dir]
+            notes_file = os.path.join(patient_dir, "notes.json")
+            if os.path.exists(notes_file):
+                patient['notes_data'] = [notes_file]
+            patients.append(patient)
+    else:
+        with open(path) as f:
+            patients = json.load(f)
+        base_dir = os.path.dirname(os.path.abspath(path))
+        for patient in patients:
+            for key in ('cgm_data', 'notes_data'):
+                paths = patient.get(key) or []
+                if isinstance(paths, str):
+                    paths = [paths]
+                patient[key] = [os.path.join(base_dir, filepath) for filepath in paths]
+
+    names = set()
+    for patient in patients:
+        name = patient.get('name')
+        unknown = sorted(set(patient) - set(BATCH_PATIENT_KEYS))
+        if unknown:
+            raise ValueError(f"Patient {name} has unknown settings {', '.join(unknown)}")
+        patient.update(parse_report_options({key: patient[key] for key in REPORT_CONFIG_KEYS if key in patient}, f"Patient {name}"))
+        # the name is the patient's directory under the output dir
+        if not name or name in names or name != os.path.basename(name) or name.startswith('.'):
+            raise ValueError(f"Patient names must be unique file names, got {name!r}")
+        if not patient.get('cgm_data'):
+            raise ValueError(f"Patient {name} has no cgm_data")
+        names.add(name)
+    return patients
+
+
+def run_batch(config, cache, executor, patients, output_dir, current_datetime):
+    """
+    --batch: renders the reports of every patient from load_batch_patients()
+    in the one process pool, each into output_dir/<name>/<timestamp> with
+    their own options.  Patients' data is loaded one after another and their
+    graphs submitted straight away, so the workers render the ones already
+    loaded while the next one loads; up to BATCH_PATIENTS_IN_FLIGHT of them
+    at a time.
+
+    Returns how many patients failed, either loading or rendering a graph.
+    """
+    logging.info(f"Generating reports for {len(patients)} patients from {config.batch}")
+    failed = 0
+    in_flight = []
+
+    def finish(run):
+        name, patient_config, data, tasks, submitted, fingerprints, manifest, shm, patient_start, stages = run
+        try:
+            first_span = len(_spans)
+            task_timings, failures = collect_reports(patient_config, data, tasks, submitted, fingerprints, manifest)
+            write_timings(patient_config.reports_dir, patient_start, task_timings, stages + _spans[first_span:])
+        finally:
+            shm.close()
+            shm.unlink()
+        if failures:
+            logging.error(f"{failures} of {len(submitted)} graphs for {name} failed")
+        return bool(failures)
+
+    try:
+        for patient in patients:
+            patient_start = time.perf_counter()
+            first_span = len(_spans)
+            patient_config = copy.copy(config)
+            for key, value in patient.items():
+                setattr(patient_config, key, value)
+            reports_dir = os.path.join(output_dir, patient['name'], date_to_output(current_datetime))
+            try:
+                data, notes, tasks, pending, fingerprints, manifest = prepare_reports(patient_config, cache, reports_dir, current_datetime)
+            except Exception:
+                failed += 1
+                logging.error(f"Loading the data for {patient['name']} failed:\n{traceback.format_exc()}")
+                continue
+            # wait for the oldest patient before loading any more data
+            while len(in_flight) >= BATCH_PATIENTS_IN_FLIGHT:
+                failed += finish(in_flight.pop(0))
+            with timed('publish_dataset'):
+                shm, shared = publish_dataset(data)
+            submitted = submit_reports(patient_config, executor, data, shared, pending, patient_config.profile_dir)
+            in_flight.append((patient['name'], patient_config, data, tasks, submitted, fingerprints, manifest, shm, patient_start, _spans[first_span:]))
+        if cache is not None:
+            cache.save()
+        while in_flight:
+            failed += finish(in_flight.pop(0))
+    finally:
+        # only if something went badly wrong, let go of the shared memory
+        for run in in_flight:
+            run[7].close()
+            run[7].unlink()
+    return failed
+
+
+def main(config):
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.DEBUG)
+    logging.getLogger('matplotlib').setLevel(logging.INFO)
+
+    #config = {
+    #    'target_min': 70,
+    #    'target_max': 180,
+    #    'time_in_tz_min': 80.0,
+    #    'time_in_tz_max': 100.0,
+    #    'time_in_tz_warn': 70.0,
+    #    'weeks_start_on': 6,  # 6 = sunday
+    #}
+
+    run_start = time.perf_counter()
+    cache = None
+    if not config.no_cache:
+        cache = ParseCache(config.cache_dir or default_cache_dir(), rebuild=config.rebuild_cache)
+
+    current_datetime = datetime.datetime.now()
+
+    if config.metrics_only:
+        data = load_config_cgm_data(config, cache)
+        if cache is not None:
+            cache.save()
+        json.dump(glucose_metrics(config, data, current_datetime), sys.stdout, indent=1)
+        print()
+        sys.exit(0)
+
+    import concurrent.futures
+    output_dir = config.output_dir or os.path.join(os.getcwd(), "reports")
+    workers = config.workers or default_worker_count()
+
+    if config.batch:
+        # a bad batch is like a bad command line, nothing gets rendered
+        try:
+            patients = load_batch_patients(config.batch)
+        except (OSError, ValueError) as e:
+            logging.error(f"Can't use batch {config.batch}: {e}")
+            sys.exit(2)
+        logging.info(f"Rendering graphs with {workers} worker processes")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            failed = run_batch(config, cache, executor, patients, output_dir, current_datetime)
+        logging.info(f"Finished batch in {time.perf_counter() - run_start:.2f}s")
+        if failed:
+            logging.error(f"{failed} patients failed")
+            sys.exit(1)
+        sys.exit(0)
+
+    watcher = None
+    if config.watch:
+        watcher = CgmWatcher(config.cgm_data)
+        watcher.start()
+
+    reports_dir = os.path.join(output_dir, date_to_output(current_datetime))
+    data, notes, tasks, pending, fingerprints, manifest = prepare_reports(config, cache, reports_dir, current_datetime, watcher)
+
+    if cache is not None:
+        cache.save()
+
+    logging.info(f"Rendering {len(pending)} graphs with {workers} worker processes")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        task_timings, failures = render_reports(config, executor, data, tasks, pending, fingerprints, manifest, config.profile_dir)
+        write_timings(reports_dir, run_start, task_timings)
+        if failures:
+            logging.error(f"{failures} of {len(pending)} graphs failed")
+            if not config.watch:
+                sys.exit(1)
+        if config.watch:
+            try:
+                watch_cgm_data(config, executor, watcher, data, notes, manifest)
+            except KeyboardInterrupt:
+                logging.info("Stopped watching")
+    sys.exit(0)
 
 
 def get_tz_state(tz_min, tz_max, glucose):
     """
     Returns -1 if below target zone, +1 if above, and 0 if inside target zone.
+
+    Works on a single glucose value or an array of them.
+    """
+    return np.where(glucose < tz_min, -1, np.where(glucose > tz_max, 1, 0))
+
+
+def to_epoch_array(time_data):
+    """
+    Converts time data (datetime64 array, or list of datetimes or epoch
+    seconds) into a float64 array of epoch seconds.
+    """
+    time_data = np.asarray(time_data)
+    if np.issubdtype(time_data.dtype, np.datetime64):
+        return time_data.astype('datetime64[s]').astype(np.int64).astype(np.float64)
+    if time_data.dtype == object:
+        return np.array([datetime_to_epoch(dt) for dt in time_data], dtype=np.float64)
+    return time_data.astype(np.float64)
+
+
+class TimeInTargetIndexBuilder:
+    """
+    Builds the index described in build_time_in_target_index() from readings
+    that arrive a chunk at a time, so it can be fed while the data is still
+    being read.  Gives exactly the same index as building it in one go.
+    """
+    def __init__(self, tz_min, tz_max, max_gap=None):
+        self.tz_min = float(tz_min)
+        self.tz_max = float(tz_max)
+        self.max_gap = max_gap
+        # the last reading seen, its stretch isn't known until the next one
+        self.last = None
+        self.readings = 0
+        self.pieces = {'time': [], 'zone': [], 'below': [], 'in_zone': [], 'above': []}
+        self.totals = {'below': 0.0, 'in_zone': 0.0, 'above': 0.0}
+
+    def add(self, time_data, glucose):
+        """
+        Adds the next readings (epoch seconds and mg/dL, sorted by time and
+        after every reading added so far).
+        """
+        time_data = np.asarray(time_data, dtype=np.float64)
+        glucose = np.asarray(glucose, dtype=np.float64)
+        if len(time_data) == 0:
+            return
+        self.readings += len(time_data)
+        if self.last is not None:
+            time_data = np.concatenate([[self.last[0]], time_data])
+            glucose = np.concatenate([[self.last[1]], glucose])
+        self.last = (time_data[-1], glucose[-1])
+
+        # readings too far apart to say anything about the time between them
+        gap = np.diff(time_data) > self.max_gap if self.max_gap is not None else np.zeros(len(time_data) - 1, dtype=bool)
+        crossings = []
+        if len(time_data) > 1:
+            time_a, time_b = time_data[:-1], time_data[1:]
+            glucose_a, glucose_b = glucose[:-1], glucose[1:]
+            glucose_range = glucose_b - glucose_a
+            with np.errstate(divide='ignore', invalid='ignore'):
+                for boundary in (self.tz_min, self.tz_max):
+                    ratio = (boundary - glucose_a) / glucose_range
+                    crosses = (glucose_range != 0) & (ratio > 0) & (ratio < 1) & ~gap
+                    crossings.append(time_a[crosses] + ratio[crosses] * (time_b[crosses] - time_a[crosses]))
+        points = np.unique(np.concatenate([time_data] + crossings))
+
+        # glucose is monotonic between two points, so the midpoint tells us the zone
+        midpoints = (points[:-1] + points[1:]) / 2
+        zone = get_tz_state(self.tz_min, self.tz_max, np.interp(midpoints, time_data, glucose)).astype(np.int8)
+        if np.any(gap):
+            pair = np.clip(np.searchsorted(time_data, midpoints, side='right') - 1, 0, len(gap) - 1)
+            zone[gap[pair]] = TZ_STATE_GAP
+        durations = np.diff(points)
+
+        # the last point is held back until the stretch after it is known
+        self.pieces['time'].append(points[:-1])
+        self.pieces['zone'].append(zone)
+        for name, state in (('below', -1), ('in_zone', 0), ('above', 1)):
+            cumulative = np.cumsum(np.concatenate([[self.totals[name]], durations * (zone == state)]))
+            self.pieces[name].append(cumulative[:-1])
+            self.totals[name] = cumulative[-1]
+
+    def finish(self):
+        """
+        Returns the index for everything added.
+        """
+        tz_index = {
+            'time': np.concatenate(self.pieces['time'] + [[self.last[0]] if self.last is not None else []]),
+            'zone': np.concatenate(self.pieces['zone'] + [[0]]).astype(np.int8),
+        }
+        for name in ('below', 'in_zone', 'above'):
+            tz_index[name] = np.concatenate(self.pieces[name] + [[self.totals[name]]])
+        logging.debug(f"Built time in target index with {len(tz_index['time']) - self.readings} crossings over {self.readings} readings")
+        return tz_index
+
+
+def build_time_in_target_index(tz_min, tz_max, time_data, glucose, max_gap=None):
+    """
+    Precomputes everything needed to answer "what ratio of [start, end) was
+    below/in/above the target zone" for any window with two binary searches.
+
+    time_data is epoch seconds, glucose is mg/dL, both sorted by time.  Every
+    point where the line between two readings crosses tz_min or tz_max is
+    added to the readings (interpolating linearly between the two readings,
+    see TimeInTargetIndexBuilder.add()), so between two neighbouring points
+    of the index the glucose is entirely in one zone.  That includes
+    readings that jump straight from below the zone to above it (or back),
+    which cross both borders.
+
+    With max_gap, the stretch between two readings more than max_gap seconds
+    apart is a gap: nothing is interpolated across it, its zone is
+    TZ_STATE_GAP and it doesn't count towards any of the zones.
+
+    Returns a dict of:
+        'time': float64 sorted readings and crossing points
+        'zone': int8 zone (see get_tz_state()) of the stretch after each point
+        'below', 'in_zone', 'above': float64 seconds spent in each zone from
+            the first point up to each point
+    """
+    builder = TimeInTargetIndexBuilder(tz_min, tz_max, max_gap)
+    builder.add(time_data, glucose)
+    return builder.finish()
+
+
+def zone_seconds_from_index(tz_index, start, end):
+    """
+    Returns (in_zone, below, above) seconds between start and end (epoch
+    seconds, scalars or arrays) spent in each zone, using an index from
+    build_time_in_target_index().  The range is truncated to the data we
+    have, and gaps don't count towards any zone.
+    """
+    points = tz_index['time']
+    start = np.asarray(start, dtype=np.float64)
+    end = np.asarray(end, dtype=np.float64)
+    if len(points) == 0:
+        zeros = np.zeros(np.broadcast(start, end).shape)
+        return (zeros, zeros, zeros)
+
+    start = np.clip(start, points[0], points[-1])
+    end = np.clip(end, points[0], points[-1])
+    start_idx = np.clip(np.searchsorted(points, start, side='right') - 1, 0, len(points) - 1)
+    end_idx = np.clip(np.searchsorted(points, end, side='right') - 1, 0, len(points) - 1)
+
+    seconds = []
+    for name, state in (('in_zone', 0), ('below', -1), ('above', 1)):
+        cumulative = tz_index[name]
+        seconds.append((cumulative[end_idx] + (end - points[end_idx]) * (tz_index['zone'][end_idx] == state)) -
+            (cumulative[start_idx] + (start - points[start_idx]) * (tz_index['zone'][start_idx] == state)))
+    return tuple(seconds)
+
+
+def time_in_zones_from_index(tz_index, start, end):
+    """
+    Returns (in_zone, below, above) ratios (0 to 1) of the time between start
+    and end spent in each zone, see zone_seconds_from_index().  Ratios are
+    of the time that has data, so gaps are left out rather than counted as
+    any zone, and ranges with no data return 0 for everything.
+    """
+    seconds = zone_seconds_from_index(tz_index, start, end)
+    total = sum(seconds)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return tuple(np.where(total > 0, time_in_zone / total, 0.0) for time_in_zone in seconds)
+
+
+def coverage_from_index(tz_index, start, end):
+    """
+    Returns the ratio (0 to 1) of the time between start and end that has
+    data, i.e. isn't in a gap or before the first or after the last reading.
+    """
+    start = np.asarray(start, dtype=np.float64)
+    end = np.asarray(end, dtype=np.float64)
+    covered = sum(zone_seconds_from_index(tz_index, start, end))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(end > start, covered / (end - start), 0.0)
+
+
+def time_in_target_from_index(tz_index, start, end):
+    """
+    Like time_in_zones_from_index(), but only returns the in zone ratio.
+    """
+    return time_in_zones_from_index(tz_index, start, end)[0]
+
+
+def max_gap_seconds(config):
+    """
+    Returns --max-gap-minutes in seconds, or None if gaps aren't left out.
+    """
+    if not config.max_gap_minutes:
+        return None
+    return float(config.max_gap_minutes) * 60
+
+
+def time_in_target_key(config):
+    """
+    Returns what the time in target index depends on, (tz_min, tz_max,
+    max_gap), as kept in its 'thresholds'.
     """
-    if glucose < tz_min:
-        return -1
-    if glucose > tz_max:
-        return 1
-    return 0
+    return (float(config.target_min), float(config.target_max), max_gap_seconds(config))
 
 
-# TODO: the arguments to this are massive, is this a bad idea to memoize?
-@memoization.cached
-def calculate_time_in_target(tz_min, tz_max, time_data, glucose, start_date=None, end_date=None):
+def get_time_in_target_index(config, data):
+    """
+    Returns the time in target index for the dataset, building it the first
+    time it is asked for and keeping it on the data for every later report.
+    """
+    key = time_in_target_key(config)
+    tz_index = data.get('tz_index')
+    if tz_index is None or tz_index['thresholds'] != key:
+        valid = data['glucose'] != GLUCOSE_MISSING
+        tz_index = build_time_in_target_index(key[0], key[1], data['time'][valid], data['glucose'][valid], key[2])
+        tz_index['thresholds'] = key
+        data['tz_index'] = tz_index
+    return tz_index
+
+
+def calculate_time_in_zones(tz_min, tz_max, time_data, glucose, windows, max_gap=None):
+    """
+    Batch version of calculate_time_in_target().  time_data and glucose are
+    float64 epoch seconds and mg/dL, windows is a list of (start, end) epoch
+    seconds.
+
+    Returns (in_zone, below, above) arrays with the ratio of each window
+    spent in each zone.
+    """
+    tz_index = build_time_in_target_index(tz_min, tz_max, time_data, glucose, max_gap)
+    windows = np.asarray(windows, dtype=np.float64).reshape(-1, 2)
+    return time_in_zones_from_index(tz_index, windows[:, 0], windows[:, 1])
+
+
+def calculate_time_in_target(tz_min, tz_max, time_data, glucose, start_date=None, end_date=None, max_gap=None):
     """
     Calculates the ratio of time between start_date and end_date that was in
     the target zone. (i.e., values 0 to 1)
@@ -275,282 +2149,751 @@ def calculate_time_in_target(tz_min, tz_max, time_data, glucose, start_date=None
     The calculation is performed thusly: when point B is on the opposite side
     of the target zone immediately after point A, the transition time is
     calculated by calculating the slope of the line connecting those points
-    then calculating where that line crosses the border of the zone.
+    then calculating where that line crosses the border of the zone.  With
+    max_gap, readings further apart than that many seconds are a gap in the
+    data, which is left out instead.  See build_time_in_target_index() for
+    the details.
+    """
+    time_data = to_epoch_array(time_data)
+    if len(time_data) == 0:
+        return 0
+    start = time_data[0] if start_date is None else datetime_to_epoch(start_date)
+    end = time_data[-1] if end_date is None else datetime_to_epoch(end_date)
+    if start > time_data[-1] or end < time_data[0]:
+        return 0
+    ratio = float(calculate_time_in_zones(tz_min, tz_max, time_data, glucose, [(start, end)], max_gap)[0][0])
+    logging.debug(f"Time in tz from {epoch_to_datetime(start)} to {epoch_to_datetime(end)} is {ratio*100:.2f}%")
+    return ratio
 
-    # ### TODO TEST CODE
-    time_data, glucose = graphify_glucose_data(data)
 
-    logging.debug("Calculating TZ data")
+def find_gaps(time_data, max_gap):
+    """
+    Returns (gap_start, gap_end), float64 epoch seconds of the readings on
+    either side of every stretch of more than max_gap seconds without one.
+    time_data is anything to_epoch_array() takes, sorted by time.
+    """
+    seconds = to_epoch_array(time_data)
+    if max_gap is None or len(seconds) < 2:
+        return (np.zeros(0), np.zeros(0))
+    gaps = np.flatnonzero(np.diff(seconds) > max_gap)
+    return (seconds[gaps], seconds[gaps + 1])
 
-    start_date = datetime.datetime(year=2022, month=4, day=3)
-    end_date = start_date+datetime.timedelta(days=7)
-    time_in_tz = calculate_time_in_target(config['target_min'], config['target_max'], time_data, glucose, start_date, end_date)
-    logging.debug(f"Time in target zone from {start_date} to {end_date} is {time_in_tz*100:.2f}")
-    # ### END TEST CODE
 
+def resample_glucose_grid(time_data, glucose, step=STATS_GRID_SECONDS, max_gap=DEFAULT_MAX_GAP_SECONDS):
+    """
+    Puts readings (time_data as anything to_epoch_array() takes, glucose in
+    mg/dL, both sorted by time) onto a regular grid of points every step
+    seconds, interpolating linearly between neighbouring readings.  Points
+    in a gap of more than max_gap seconds between two readings (see
+    find_gaps()) get no value.  The grid is aligned to multiples of step, so every graph uses
+    the same points.
+
+    Returns (grid_time, grid_glucose, valid): float64 epoch seconds, float64
+    mg/dL and a bool mask of the points that have a value.
     """
-    # Find the start point and end point
-    if start_date is None:
-        start_date = time_data[0]
-    if end_date is None:
-        end_date = time_data[-1]
+    seconds = to_epoch_array(time_data)
+    glucose = np.asarray(glucose, dtype=np.float64)
+    if len(seconds) == 0:
+        return (np.zeros(0), np.zeros(0), np.zeros(0, dtype=bool))
+    first = np.ceil(seconds[0] / step) * step
+    grid_time = first + step * np.arange(max(int((seconds[-1] - first) // step) + 1, 0))
+    after = np.searchsorted(seconds, grid_time, side='right')
+    before = np.clip(after - 1, 0, len(seconds) - 1)
+    after = np.clip(after, 0, len(seconds) - 1)
+    valid = np.ones(len(grid_time), dtype=bool)
+    if max_gap is not None:
+        valid = (seconds[after] - seconds[before]) <= max_gap
+    return (grid_time, np.interp(grid_time, seconds, glucose), valid)
+
+
+def build_glucose_stats_index(time_data, glucose, max_gap=DEFAULT_MAX_GAP_SECONDS):
+    """
+    Precomputes everything needed for the mean glucose, SD, CV and GMI of
+    any window with two binary searches, the same way the time in target
+    index works: the readings are resampled with resample_glucose_grid()
+    (leaving out gaps of more than max_gap seconds) and the count, sum and sum of squares of the points that have a value
+    are accumulated over the grid.
+
+    Returns a dict of:
+        'time': float64 epoch seconds of the grid points
+        'count', 'sum', 'sum_sq': float64 totals over the points before each
+            grid point, with one more entry at the end for all of them
+        'offset': mg/dL subtracted from every value before summing, which
+            keeps the sums of squares small enough to stay precise
+    """
+    grid_time, grid_glucose, valid = resample_glucose_grid(time_data, glucose, max_gap=max_gap)
+    offset = float(np.mean(grid_glucose[valid])) if np.any(valid) else 0.0
+    values = np.where(valid, grid_glucose - offset, 0.0)
+    stats_index = {'time': grid_time, 'offset': offset}
+    for name, column in (('count', valid.astype(np.float64)), ('sum', values), ('sum_sq', values * values)):
+        stats_index[name] = np.concatenate([[0.0], np.cumsum(column)])
+    return stats_index
 
-    # if there is no data, return 0
-    if start_date > time_data[-1]:
-        return 0
-    if end_date < time_data[0]:
-        return 0
 
-    # if start date is before first data point, or after last data point, truncate range to our data.
-    if start_date < time_data[0]:
-        start_date = time_data[0]
-    if end_date > time_data[-1]:
-        end_date = time_data[-1]
-
-    # we might be given a start/end time which falls between two data points.
-    # If that happens, we need to calculate the state at that time using our
-    # avg method.
-    time_deltas_in_zone = []
-    tz_state = None
-    new_tz_state = None
-    last_transition_date = start_date
-    for i in range(len(time_data)):
-        if start_date == time_data[i]:
-            tz_state = get_tz_state(tz_min, tz_max, glucose[i])
-            continue
-        if start_date < time_data[i] and start_date > time_data[i - 1]:
-            start_glucose = calculate_glucose_between_two_times(time_data[i - 1], glucose[i - 1], start_date, time_data[i], glucose[i])
-            tz_state = get_tz_state(tz_min, tz_max, start_glucose)
-            continue
-        if tz_state is None:
-            # haven't found start yet
-            continue
-        # we are now in the range of interest.  See if we are at the end?
-        if end_date == time_data[i]:
-            # if we are at the end, all that matters is that if we are in our
-            # TZ, we need to count this stretch as a timedelta in the tz.
-            if tz_state == 0:
-                time_deltas_in_zone.append(end_date - last_transition_date)
-                break
-        if time_data[i] > end_date:
-            if tz_state == 0:
-                # we were in target zone, make sure we still are
-                # we went past the end of the range, so let's calculate what the glucose was exactly at the end.
-                end_glucose = calculate_glucose_between_two_times(time_data[i - 1], glucose[i - 1], end_date, time_data[i], glucose[i])
-                new_tz_state = get_tz_state(tz_min, tz_max, end_glucose)
-                if new_tz_state == 0:
-                    # in the zone until the end
-                    time_deltas_in_zone.append(end_date - last_transition_date)
-                    break
-            # else, we are not in tz, who cares if we are just starting being in the zone, it's right at the end.  we can probably drop that datapoint.
-            break
-
-        # ok, not at the end yet, detect a mid-range transition
-        new_tz_state = get_tz_state(tz_min, tz_max, glucose[i])
-        if new_tz_state != tz_state:
-            # we have transitioned.  3 states, 6 possible transitions:
-            # 1 to 0, 1 to -1, 0 to 1, 0 to -1, -1 to 0, -1 to 1.
-            # BUG: for now, we will ignore transitions from -1 to 1 or 1 to -1
-            # what we COULD do is linear extrapolate when you entered and left
-            # the zone but frankly if you have holes in your data that big, big
-            # enough to make that jump, you probably aren't going to get useful
-            # data anyways.
-            pair = (tz_state, new_tz_state)
-            if pair == (-1, 1) or pair == (1, -1):
-                # still outside tz, nothing to do
-                continue
-            if pair == (0, 1):
-                # was in tz, left tz on top
-                time_left_tz = calculate_time_glucose_transitions(time_data[i - 1], glucose[i - 1], tz_max, time_data[i], glucose[i])
-                time_deltas_in_zone.append(time_left_tz - last_transition_date)
-                last_transition_date = time_left_tz
-                tz_state = new_tz_state
-                continue
-            if pair == (0, -1):
-                # was in tz, left tz on bottom
-                time_left_tz = calculate_time_glucose_transitions(time_data[i - 1], glucose[i - 1], tz_min, time_data[i], glucose[i])
-                time_deltas_in_zone.append(time_left_tz - last_transition_date)
-                last_transition_date = time_left_tz
-                tz_state = new_tz_state
-                continue
-            if pair == (1, 0):
-                # entered tz on top
-                time_entered_tz = calculate_time_glucose_transitions(time_data[i - 1], glucose[i - 1], tz_max, time_data[i], glucose[i])
-                last_transition_date = time_entered_tz
-                tz_state = new_tz_state
-                continue
-            if pair == (-1, 0):
-                # entered tz on bottom
-                time_entered_tz = calculate_time_glucose_transitions(time_data[i - 1], glucose[i - 1], tz_min, time_data[i], glucose[i])
-                last_transition_date = time_entered_tz
-                tz_state = new_tz_state
-                continue
-    # ok, we have collected all the time deltas in the TZ.  Ratio in tz is now sum of all deltas over end - start.
-    total_time_in_tz = sum(time_deltas_in_zone, datetime.timedelta())
-    total_time_range = end_date - start_date
-    ratio = total_time_in_tz / total_time_range
-    logging.debug(f"Found {len(time_deltas_in_zone)} times in tz totalling {total_time_in_tz} out of {total_time_range} or {ratio*100:.2f}%")
-    return ratio
+def glucose_stats_from_index(stats_index, start, end, min_coverage=STATS_MIN_COVERAGE):
+    """
+    Returns the glucose statistics for the time from start to end (epoch
+    seconds, inclusive, scalars or arrays) using an index from
+    build_glucose_stats_index(), as a dict of:
+        'mean': mean glucose (mg/dL)
+        'sd': sample standard deviation (mg/dL)
+        'cv': coefficient of variation, sd / mean (%)
+        'gmi': glucose management indicator, 3.31 + 0.02392 * mean (%)
+        'coverage': ratio (0 to 1) of the window that has data
+
+    Windows with less than min_coverage of their time covered get NaN for
+    everything but coverage, so plotted lines break there instead of
+    drawing a few readings as a trend.
+    """
+    start = np.asarray(start, dtype=np.float64)
+    end = np.asarray(end, dtype=np.float64)
+    lo = np.searchsorted(stats_index['time'], start, side='left')
+    hi = np.searchsorted(stats_index['time'], end, side='right')
+    count = stats_index['count'][hi] - stats_index['count'][lo]
+    total = stats_index['sum'][hi] - stats_index['sum'][lo]
+    total_sq = stats_index['sum_sq'][hi] - stats_index['sum_sq'][lo]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # a window of n grid steps has n + 1 points in it
+        coverage = np.clip(count / np.maximum((end - start) / STATS_GRID_SECONDS + 1, 1), 0.0, 1.0)
+        usable = (count > 0) & (coverage >= min_coverage)
+        mean = np.where(usable, total / count + stats_index['offset'], np.nan)
+        variance = np.where(usable & (count > 1), (total_sq - total * total / count) / (count - 1), np.nan)
+        sd = np.sqrt(np.maximum(variance, 0.0))
+        return {
+            'mean': mean,
+            'sd': sd,
+            'cv': 100.0 * sd / mean,
+            'gmi': 3.31 + 0.02392 * mean,
+            'coverage': coverage,
+        }
+
+
+def rolling_glucose_stats(stats_index, window, max_points=None):
+    """
+    Returns (time, stats) for windows of window seconds centered on the grid
+    points of a build_glucose_stats_index() index, stats as from
+    glucose_stats_from_index().  With max_points, only every so many grid
+    points get a window, so there are at most about that many.
+    """
+    centers = stats_index['time']
+    if max_points is not None and len(centers) > max_points:
+        centers = centers[::-(-len(centers) // max_points)]
+    return (centers, glucose_stats_from_index(stats_index, centers - window / 2, centers + window / 2))
+
+
+def percentiles_by_bucket(bucket, values, buckets, percentiles):
+    """
+    Returns a (len(percentiles), buckets) float64 array of the given
+    percentiles (0 to 100) of the values in each bucket, interpolated the
+    same way as np.percentile().  bucket is the bucket (0 to buckets - 1)
+    of each value.  Buckets without any values get NaN.
+
+    Everything is sorted once by bucket then value, so each percentile of
+    every bucket is just a lookup into its run of the sorted values.
+    """
+    sorted_values = np.asarray(values, dtype=np.float64)[np.lexsort((values, bucket))]
+    counts = np.bincount(bucket, minlength=buckets)
+    starts = np.cumsum(counts) - counts
+    has_values = counts > 0
+    position = starts[has_values] + (counts[has_values] - 1) * (np.asarray(percentiles, dtype=np.float64)[:, None] / 100)
+    below = np.floor(position).astype(np.int64)
+    above = np.ceil(position).astype(np.int64)
+    result = np.full((len(percentiles), buckets), np.nan)
+    result[:, has_values] = sorted_values[below] + (sorted_values[above] - sorted_values[below]) * (position - below)
+    return result
 
 
+
+@timed('graphify_glucose_data')
 def graphify_glucose_data(data, start_date=None, end_date=None):
+    """
+    Returns (time_data, glucose) arrays for every reading between start_date
+    and end_date (inclusive), time_data as datetime64[s] and glucose as int.
+    """
     logging.debug("Graphifying glucose data set")
+    times = data['time']
+    start_idx = 0
+    end_idx = len(times)
     if start_date:
         logging.debug(f"Limiting dataset to dates after {date_to_output(start_date)}")
+        start_idx = np.searchsorted(times, datetime_to_epoch(start_date), side='left')
     if end_date:
         logging.debug(f"Limiting dataset to dates before {date_to_output(end_date)}")
+        end_idx = np.searchsorted(times, datetime_to_epoch(end_date), side='right')
 
-    time_data = []
-    glucose = []
-    for ts in sorted(data.keys()):
-        # include all valid data in our range
-        if start_date and data[ts]['datetime'] < start_date:
-            # date is before start date
-            continue
-        if end_date and data[ts]['datetime'] > end_date:
-            # date is after end date
-            continue
-
-        # prefer glucose if available, but most data will be historic glucose
-        # becuase that is the column that the CGMs fill in.
-        if data[ts]['glucose']:
-            time_data.append(data[ts]['datetime'])
-            glucose.append(int(data[ts]['glucose']))
-            continue
-        if data[ts]['historic_glucose']:
-            time_data.append(data[ts]['datetime'])
-            glucose.append(int(data[ts]['historic_glucose']))
-            continue
-        #logging.debug(f"Skipping timestamp {ts} because it has no glucose data")
-    return (time_data, glucose)
+    # the loader already prefers scan glucose over historic glucose, all we
+    # need to do is skip rows without any glucose data
+    glucose = data['glucose'][start_idx:end_idx]
+    valid = glucose != GLUCOSE_MISSING
+    time_data = times[start_idx:end_idx][valid].astype('datetime64[s]')
+    return (time_data, glucose[valid].astype(np.int64))
 
 
+@timed('graphify_time_in_tz_data')
 def graphify_time_in_tz_data(config, data, start_date=None, end_date=None, interval=datetime.timedelta(days=1)):
     logging.debug("Graphifying time in tz data set")
     time_data, glucose = graphify_glucose_data(data, start_date, end_date)
+    if len(time_data) == 0:
+        return ([], [])
+    tz_index = get_time_in_target_index(config, data)
+    bucket_start, bucket_end = time_in_tz_buckets(time_data, interval)
+    time_in_tz_y = 100.0 * time_in_target_from_index(tz_index, bucket_start, bucket_end)
+    # buckets that are all gap have no time in target, not 0%
+    time_in_tz_y[coverage_from_index(tz_index, bucket_start, bucket_end) == 0] = np.nan
+    time_in_tz_x = bucket_start.astype('datetime64[s]')
+    return (time_in_tz_x, time_in_tz_y)
 
-    time_in_tz_x = []
-    time_in_tz_y = []
 
-    #tz_time = calculate_time_in_target(config['target_min'], config['target_max'], time_data, glucose)
-    current_day = time_data[0]
-    while current_day <= time_data[-1]:
-        time_in_tz_x.append(current_day)
-        time_in_tz_y.append(100.0*calculate_time_in_target(config.target_min, config.target_max, time_data, glucose, current_day, current_day + interval))
-        current_day = current_day + interval
-    return (time_in_tz_x, time_in_tz_y)
+@timed('graphify_coverage_data')
+def graphify_coverage_data(config, data, start_date=None, end_date=None, interval=datetime.timedelta(days=1)):
+    """
+    Returns the coverage (%) of each bucket of the graphify_time_in_tz_data()
+    graph with the same arguments, see coverage_from_index().
+    """
+    time_data, glucose = graphify_glucose_data(data, start_date, end_date)
+    if len(time_data) == 0:
+        return []
+    bucket_start, bucket_end = time_in_tz_buckets(time_data, interval)
+    return 100.0 * coverage_from_index(get_time_in_target_index(config, data), bucket_start, bucket_end)
 
 
-def generate_glucose_plot_from_data(output_file, title, config, time_data, glucose):
-    # some calculations before we get started...
-    # time in target for entire graph
-    tz_time = calculate_time_in_target(config.target_min, config.target_max, time_data, glucose)
-    # y_min = int(np.min(glucose) * 0.95)
-    # y_max = int(np.max(glucose) * 1.05)
-    # y_ticks = 20
-
-    # To find list of valid params here: pprint.pprint(plt.rcParams.keys())
-    with plt.rc_context({
+def time_in_tz_buckets(time_data, interval):
+    """
+    Returns (bucket_start, bucket_end) epoch seconds for the buckets of a
+    time in tz graph of the given readings.
+    """
+    # one bucket per interval starting at the first reading, the last one
+    # is cut short at the last reading like everything else.
+    first = time_data[0].astype(np.int64)
+    last = time_data[-1].astype(np.int64)
+    step = interval.total_seconds()
+    bucket_start = first + step * np.arange(int((last - first) // step) + 1)
+    bucket_end = np.minimum(bucket_start + step, last)
+    return (bucket_start, bucket_end)
+
+
+@timed('graphify_rolling_time_in_tz_data')
+def graphify_rolling_time_in_tz_data(config, data, start_date=None, end_date=None, interval=datetime.timedelta(days=1), window=datetime.timedelta(days=7)):
+    """
+    Returns (window, values) for a rolling time in target line over the
+    graphify_time_in_tz_data() graph with the same arguments: the time in
+    target (%) of a window as long as the window timedelta, centered on
+    each bucket.  Windows are cut short at the ends of the graph, so it
+    only depends on the readings the graph has, and windows with less than
+    STATS_MIN_COVERAGE of their time covered get NaN.  Returns None if the
+    graph is empty.
+    """
+    time_data, glucose = graphify_glucose_data(data, start_date, end_date)
+    if len(time_data) == 0:
+        return None
+    tz_index = get_time_in_target_index(config, data)
+    bucket_start, bucket_end = time_in_tz_buckets(time_data, interval)
+    middle = bucket_start + interval.total_seconds() / 2
+    half = window.total_seconds() / 2
+    start = np.maximum(middle - half, bucket_start[0])
+    end = np.minimum(middle + half, bucket_end[-1])
+    rolling = 100.0 * time_in_target_from_index(tz_index, start, end)
+    rolling[coverage_from_index(tz_index, start, end) < STATS_MIN_COVERAGE] = np.nan
+    return (window, rolling)
+
+
+@timed('graphify_agp_data')
+def graphify_agp_data(data, start_date=None, end_date=None, bucket_minutes=AGP_BUCKET_MINUTES):
+    """
+    Returns (time_of_day, percentiles, days) for an ambulatory glucose
+    profile of the readings between start_date and end_date: every reading
+    goes into a bucket_minutes wide bucket by its time of day, and
+    percentiles has a row for each of AGP_PERCENTILES over the buckets.
+    time_of_day is the middle of each bucket as datetime64[s] on the first
+    day of the epoch, days is how many days have readings.  Everything is
+    empty if there are no readings.
+    """
+    time_data, glucose = graphify_glucose_data(data, start_date, end_date)
+    if len(time_data) == 0:
+        return (np.zeros(0, dtype='datetime64[s]'), np.zeros((len(AGP_PERCENTILES), 0)), 0)
+    seconds = time_data.astype(np.int64)
+    bucket_seconds = bucket_minutes * 60
+    buckets = -(-86400 // bucket_seconds)
+    bucket = (seconds % 86400) // bucket_seconds
+    percentiles = percentiles_by_bucket(bucket, glucose, buckets, AGP_PERCENTILES)
+    time_of_day = (bucket_seconds * np.arange(buckets) + bucket_seconds // 2).astype('datetime64[s]')
+    days = len(np.unique(seconds // 86400))
+    return (time_of_day, percentiles, days)
+
+
+def downsample_glucose_data(time_data, glucose, buckets=DOWNSAMPLE_BUCKETS):
+    """
+    Cuts the data down to what can actually be seen on a graph: the time
+    range is split into equal buckets (roughly pixel columns) and only the
+    lowest and highest reading in each bucket are kept, in time order.
+    Every peak and low stays visible, the first and last points are always
+    kept, and data that is already small enough is returned as is.
+    """
+    if len(time_data) <= 2 * buckets:
+        return (time_data, glucose)
+    seconds = to_epoch_array(time_data)
+    span = seconds[-1] - seconds[0]
+    if span <= 0:
+        return (time_data, glucose)
+    bucket = np.minimum(((seconds - seconds[0]) / span * buckets).astype(np.int64), buckets - 1)
+
+    # sort by bucket then glucose, so the first and last entry of each bucket
+    # are its lowest and highest reading
+    order = np.lexsort((glucose, bucket))
+    sorted_bucket = bucket[order]
+    starts = np.flatnonzero(np.diff(sorted_bucket, prepend=-1))
+    ends = np.append(starts[1:], len(order)) - 1
+    keep = np.unique(np.concatenate([order[starts], order[ends], [0, len(time_data) - 1]]))
+    logging.debug(f"Downsampled {len(time_data)} readings to {len(keep)} points")
+    return (time_data[keep], glucose[keep])
+
+
+def import_plotting():
+    """
+    Imports matplotlib and the parts of it the renderers use, and returns
+    it.  This takes most of a second, so it isn't done until something gets
+    plotted: --metrics-only never does, and the workers do it once when
+    they start (see init_worker()).
+    """
+    import matplotlib
+    # figures are drawn straight onto an Agg canvas, nothing needs a display
+    matplotlib.use('Agg')
+    import matplotlib.backends.backend_agg
+    import matplotlib.collections
+    import matplotlib.dates
+    import matplotlib.figure
+    return matplotlib
+
+
+class PlotRenderer:
+    """
+    A figure with everything that is the same for every graph of one kind
+    (labels, ticks, target zone lines and fills, legend) drawn once.  Each
+    graph only swaps in its line data, title and notes, then the line data
+    and notes are dropped again so the figure doesn't hold on to anything.
+
+    Workers keep one of these per kind of graph, see get_plot_renderer().
+    """
+    # To find list of valid params here: pprint.pprint(matplotlib.rcParams.keys())
+    rc = {
         'axes.autolimit_mode': 'round_numbers',
         'figure.figsize': [20, 4],  # todo: extract this?
         'axes.xmargin': 0.001,
         'savefig.bbox': 'tight',
         'savefig.pad_inches': 0.1,
-    }):
+    }
+    line_label = None
+    # whether notes inside the graph get drawn on it
+    annotate_notes = True
+    # whether the graph can have a rolling average drawn over it
+    rolling_average = True
+
+    def __init__(self, config):
+        matplotlib = import_plotting()
+        with matplotlib.rc_context(self.rc):
+            # not created through pyplot, so pyplot never holds on to it
+            self.figure = matplotlib.figure.Figure()
+            matplotlib.backends.backend_agg.FigureCanvasAgg(self.figure)
+            self.ax = self.figure.subplots()
+            self.title = self.figure.suptitle("")
+            self.ax.set_xlabel("Date")
+            self.ax.xaxis_date()
+            (self.line,) = self.ax.plot([], [], 'k.-', label=self.line_label)
+            # rolling average drawn over the line, its label says the window
+            (self.overlay,) = self.ax.plot([], [], '-', color='tab:blue', linewidth=2, label=" " if self.rolling_average else None)
+            self.decorate(config)
+            self.legend = self.ax.legend()
+            # what the axes look like with no data, a graph without any
+            # mustn't pick up the limits of the one drawn before it
+            self.ax.relim()
+            self.ax.autoscale_view()
+            self.empty_limits = (self.ax.get_xlim(), self.ax.get_ylim())
+
+    def decorate(self, config):
+        """
+        Draws everything specific to this kind of graph that doesn't change
+        between graphs.
+        """
+        raise NotImplementedError()
+
+    def render(self, output_file, title, config, time_data, values, overlay=None, gaps=None, coverage=None, notes_window=None):
+        """
+        Draws one graph to output_file.  overlay is (time_data, values, label)
+        for a rolling average line, or None.  gaps is (gap_start, gap_end)
+        epoch seconds (see find_gaps()) to shade, and coverage the coverage
+        (%) of each point, the rest of which is shaded down from the top.
+        notes_window is (first, last) epoch seconds of the readings behind
+        the graph (see dataset_time_window()), the notes in it get drawn.
+        Without it, the notes between the first and last point are drawn,
+        which misses the end of the last bucket of time in zone graphs.
+        """
+        matplotlib = import_plotting()
+        with matplotlib.rc_context(self.rc):
+            # relim() works out the limits of the target zone lines through
+            # the current view limits, so start from the same ones every
+            # time, or the last graph shifts this one by a rounding error
+            self.ax.set_xlim(self.empty_limits[0], auto=None)
+            self.ax.set_ylim(self.empty_limits[1], auto=None)
+            self.title.set_text(title)
+            self.line.set_data(time_data, values)
+            shading = []
+            if gaps is not None and len(gaps[0]):
+                # one collection for every gap, spanning the whole height
+                gap_start = matplotlib.dates.date2num(gaps[0].astype('datetime64[s]'))
+                gap_end = matplotlib.dates.date2num(gaps[1].astype('datetime64[s]'))
+                shading.append(self.ax.add_collection(matplotlib.collections.PolyCollection(
+                    [[(s, 0), (s, 1), (e, 1), (e, 0)] for s, e in zip(gap_start, gap_end)],
+                    transform=self.ax.get_xaxis_transform(), facecolor='lightgrey', alpha=0.6, linewidth=0, zorder=1.5,
+                ), autolim=False))
+            if coverage is not None and len(coverage):
+                shading.append(self.ax.fill_between(time_data, coverage, 100, step='post', facecolor='lightgrey', alpha=0.6, linewidth=0, zorder=1.5))
+            if self.rolling_average:
+                overlay_text = self.legend.get_texts()[1]
+                if overlay is not None:
+                    self.overlay.set_data(overlay[0], overlay[1])
+                # hidden text still sizes the legend, so don't keep the last
+                # graph's around
+                overlay_text.set_text(overlay[2] if overlay is not None else " ")
+                self.overlay.set_visible(overlay is not None)
+                self.legend.get_lines()[1].set_visible(overlay is not None)
+                overlay_text.set_visible(overlay is not None)
+            self.ax.relim()
+            if notes_window is not None and len(time_data):
+                # the points of time in zone graphs are the start of each
+                # bucket, the graph still goes on to the last reading (and
+                # the notes up to it)
+                window = matplotlib.dates.date2num(np.array(notes_window).astype('datetime64[s]'))
+                self.ax.update_datalim([(when, 0) for when in window], updatey=False)
+            self.ax.autoscale_view()
+            if len(time_data) == 0:
+                self.ax.set_xlim(self.empty_limits[0], auto=None)
+                self.ax.set_ylim(self.empty_limits[1], auto=None)
+            self.figure.autofmt_xdate()
+            (ylim_min, ylim_max) = self.ax.get_ybound()
+
+            # draw labeled notes if present, but only the ones on this graph
+            annotations = []
+            notes = []
+            if notes_window is None and len(time_data):
+                notes_window = (to_epoch_array(time_data[:1])[0], to_epoch_array(time_data[-1:])[0])
+            if notes_window is not None and len(time_data) and self.annotate_notes:
+                notes = config.notes.between(*notes_window)
+            for when, note in notes:
+                logging.debug(f"Annotating datetime {note['datetime']} with text '{note['text']}'")
+                annotations.append(self.ax.annotate(
+                    note['text'], (epoch_to_datetime(when), ylim_min),
+                    xytext=(90, -20), textcoords='offset pixels',
+                    arrowprops=dict(facecolor='red', width=0.1, headwidth=4, headlength=4),
+                    fontsize=7,
+                    horizontalalignment='right', verticalalignment='top',
+                ))
+            try:
+                with timed('savefig'):
+                    self.figure.savefig(output_file)
+            finally:
+                for artist in annotations + shading:
+                    artist.remove()
+                self.line.set_data([], [])
+                self.overlay.set_data([], [])
+
+    def close(self):
+        self.figure.clear()
+        self.figure = None
+
+
+class GlucosePlotRenderer(PlotRenderer):
+    line_label = "Blood Glucose Level (mg/dL)"
+
+    def decorate(self, config):
+        self.ax.set_ylabel("Blood Glucose Level (mg/dL)")
+        self.ax.set_yticks(np.arange(30, 500, 20))
+
+        # draw target zone
+        self.ax.axhline(y=config.target_min, color='green', linestyle='--')
+        self.ax.axhline(y=config.target_max, color='red', linestyle='--')
+        self.ax.axhspan(config.target_min, config.target_max, color='palegreen')
 
-        fig, ax = plt.subplots()
-        fig.suptitle(title + f" (time in target: {tz_time*100:.1f}%)")
-        ax.set_xlabel("Date")
-        ax.set_ylabel("Blood Glucose Level (mg/dL)")
-        ax.set_yticks(np.arange(30, 500, 20))
-        fig.autofmt_xdate()
 
-        ax.plot(time_data, glucose, 'k.-', label="Blood Glucose Level (mg/dL)")
+class TimeInZonePlotRenderer(PlotRenderer):
+    line_label = "Time in target zone (%)"
+
+    def decorate(self, config):
+        self.ax.set_ylabel("Time in target zone (%)")
+        self.ax.set_yticks(np.arange(0, 100, 5))
+
+        # draw target zone
+        self.ax.axhline(y=config.time_in_tz_max, color='green', linestyle='--')
+        self.ax.axhline(y=config.time_in_tz_min, color='orange', linestyle='--')
+        self.ax.axhline(y=config.time_in_tz_warn, color='red', linestyle='--')
+        self.ax.axhspan(config.time_in_tz_min, config.time_in_tz_max, color='palegreen')
+        self.ax.axhspan(config.time_in_tz_warn, config.time_in_tz_min, color='palegoldenrod')
+
+
+class AgpPlotRenderer(PlotRenderer):
+    """
+    Ambulatory glucose profile: the median glucose by time of day, with the
+    25th to 75th and 5th to 95th percentiles as bands around it.  The
+    values to render are the rows of graphify_agp_data()'s percentiles.
+    """
+    line_label = "Median"
+    # the x axis is time of day, not dates
+    annotate_notes = False
+    rolling_average = False
+
+    def decorate(self, config):
+        matplotlib = import_plotting()
+        self.ax.set_xlabel("Time of day")
+        self.ax.set_ylabel("Blood Glucose Level (mg/dL)")
+        self.ax.set_yticks(np.arange(30, 500, 20))
+        self.ax.xaxis.set_major_locator(matplotlib.dates.HourLocator(byhour=range(0, 24, 2)))
+        self.ax.xaxis.set_major_formatter(matplotlib.dates.DateFormatter('%H:%M'))
+
+        # the outer percentiles are lines too, so autoscaling covers the bands
+        (self.outer_low,) = self.ax.plot([], [], 'k--', linewidth=0.8)
+        (self.outer_high,) = self.ax.plot([], [], 'k--', linewidth=0.8)
+        # empty, just for the legend, render() draws the real bands
+        self.ax.fill_between([], [], [], color='lightsteelblue', label="5th to 95th percentile")
+        self.ax.fill_between([], [], [], color='cornflowerblue', label="25th to 75th percentile")
 
         # draw target zone
-        plt.axhline(y=config.target_min, color='green', linestyle='--')
-        plt.axhline(y=config.target_max, color='red', linestyle='--')
-        (xlim_min, xlim_max) = ax.get_xbound()
-        (ylim_min, ylim_max) = ax.get_ybound()
-        plt.fill((xlim_min, xlim_max, xlim_max, xlim_min), (config.target_min, config.target_min, config.target_max, config.target_max), 'palegreen')
-
-        # draw labeled notes if present
-        for note in config.notes:
-            logging.info(f"Annotating datetime {note['datetime']} with text '{note['text']}'")
-            ax.annotate(
-                note['text'], (note['datetime'], ylim_min),
-                xytext=(90, -20), textcoords='offset pixels',
-                arrowprops=dict(facecolor='red', width=0.1, headwidth=4, headlength=4),
-                fontsize=7,
-                horizontalalignment='right', verticalalignment='top',
-            )
-
-        legend = ax.legend()
-        plt.savefig(output_file)
-
-def generate_time_in_tz_plot_from_data(output_file, title, config, time_data, time_in_tz):
+        self.ax.axhline(y=config.target_min, color='green', linestyle='--')
+        self.ax.axhline(y=config.target_max, color='red', linestyle='--')
+
+    def render(self, output_file, title, config, time_data, values, overlay=None):
+        low, lower, median, upper, high = values
+        bands = [
+            self.ax.fill_between(time_data, low, high, color='lightsteelblue', linewidth=0),
+            self.ax.fill_between(time_data, lower, upper, color='cornflowerblue', linewidth=0),
+        ]
+        self.outer_low.set_data(time_data, low)
+        self.outer_high.set_data(time_data, high)
+        try:
+            super().render(output_file, title, config, time_data, median, overlay)
+        finally:
+            for band in bands:
+                band.remove()
+            self.outer_low.set_data([], [])
+            self.outer_high.set_data([], [])
+
+
+# renderers this process has set up, by kind
+_plot_renderers = {}
+
+
+def init_worker():
+    """
+    Runs once in every worker process as the pool starts it, so the first
+    graph each worker renders doesn't pay for importing matplotlib.
+    """
+    import_plotting()
+
+
+def get_plot_renderer(renderer_class, config):
+    """
+    Returns this process's renderer of the given class decorated for the
+    config, making a new one if there isn't one yet.  Only the most recently
+    used few configs are kept (--batch patients can each have their own).
+    """
+    key = (renderer_class, tuple(getattr(config, name, None) for name in REPORT_CONFIG_KEYS))
+    renderer = _plot_renderers.pop(key, None)
+    if renderer is None:
+        stale = [other for other in _plot_renderers if other[0] is renderer_class]
+        for other in stale[:max(len(stale) - BATCH_PATIENTS_IN_FLIGHT + 1, 0)]:
+            _plot_renderers.pop(other).close()
+        with timed('create_renderer'):
+            renderer = renderer_class(config)
+    # most recently used last
+    _plot_renderers[key] = renderer
+    return renderer
+
+
+def describe_window(window):
+    """
+    Returns e.g. "7 day" or "4 week" for a rolling window timedelta.
+    """
+    days = window.total_seconds() / 86400
+    if days >= 7 and days % 7 == 0:
+        return f"{days / 7:g} week"
+    return f"{days:g} day"
+
+
+@timed('glucose_plot')
+def generate_glucose_plot_from_data(output_file, title, config, time_data, glucose, downsample=False, rolling_window=None, tz_index=None, notes_window=None):
+    """
+    Plots glucose over time.  With downsample, long data sets only draw the
+    points downsample_glucose_data() keeps; the time in target and the
+    glucose statistics are still calculated from all of the data.  With
+    rolling_window (a timedelta), the mean glucose over a window that long
+    is drawn over the readings.  Gaps in the data are shaded.
+
+    tz_index is the dataset's time in target index (see
+    get_time_in_target_index()), if the readings come from one, so the time
+    in target doesn't need an index of its own.  notes_window is passed on
+    to PlotRenderer.render().
+    """
+    # some calculations before we get started...
+    # time in target and glucose statistics for entire graph
+    max_gap = max_gap_seconds(config)
+    if tz_index is not None:
+        tz_time = float(time_in_target_from_index(tz_index, *to_epoch_array(time_data[[0, -1]]))) if len(time_data) else 0
+    else:
+        tz_time = calculate_time_in_target(config.target_min, config.target_max, time_data, glucose, max_gap=max_gap)
+    gaps = find_gaps(time_data, max_gap)
+    with timed('glucose_stats'):
+        stats_index = build_glucose_stats_index(time_data, glucose, max_gap)
+        overall = glucose_stats_from_index(stats_index, stats_index['time'][:1], stats_index['time'][-1:], min_coverage=0.0)
+        overlay = None
+        if rolling_window is not None:
+            rolling_time, rolling = rolling_glucose_stats(stats_index, rolling_window.total_seconds(), DOWNSAMPLE_BUCKETS if downsample else None)
+            # no legend entry for a line with nothing to draw
+            if not np.isnan(rolling['mean']).all():
+                overlay = (rolling_time.astype('datetime64[s]'), rolling['mean'], f"{describe_window(rolling_window)} rolling mean glucose (mg/dL)")
+    summary = f"time in target: {tz_time*100:.1f}%"
+    if len(overall['mean']) and not np.isnan(overall['mean'][0]):
+        summary += f", mean: {overall['mean'][0]:.0f} mg/dL, GMI: {overall['gmi'][0]:.1f}%"
+        if not np.isnan(overall['cv'][0]):
+            summary += f", CV: {overall['cv'][0]:.1f}%"
+        summary += f", coverage: {overall['coverage'][0]*100:.1f}%"
+    if downsample:
+        with timed('downsample'):
+            time_data, glucose = downsample_glucose_data(time_data, glucose)
+
+    renderer = get_plot_renderer(GlucosePlotRenderer, config)
+    renderer.render(output_file, title + f" ({summary})", config, time_data, glucose, overlay, gaps=gaps, notes_window=notes_window)
+
+
+@timed('time_in_tz_plot')
+def generate_time_in_tz_plot_from_data(output_file, title, config, time_data, time_in_tz, rolling=None, coverage=None, notes_window=None):
+    """
+    Plots time in zone over time.  rolling is (window timedelta, values)
+    for a rolling time in target line over it, see
+    graphify_rolling_time_in_tz_data().  coverage is the coverage (%) of
+    each bucket from graphify_coverage_data(), the part of each bucket
+    without data is shaded.  time_data only has the start of each bucket,
+    so the notes to draw go by notes_window, see PlotRenderer.render().
+    """
     # some upfront calculations
-    avg_tz_time = np.average(time_in_tz)  # this works because time_data is always equally spaced out
+    # this works because time_data is always equally spaced out, buckets
+    # without any data don't count, and there's no average without any
+    if not np.isnan(time_in_tz).all():
+        title += f" (all-time average: {np.nanmean(time_in_tz):.1f}%)"
 
-    # To find list of valid params here: pprint.pprint(plt.rcParams.keys())
-    with plt.rc_context({
-        'axes.autolimit_mode': 'round_numbers',
-        'figure.figsize': [20, 4],  # todo: extract this?
-        'axes.xmargin': 0.001,
-        'savefig.bbox': 'tight',
-        'savefig.pad_inches': 0.1,
-    }):
+    overlay = None
+    if rolling is not None:
+        overlay = (time_data, rolling[1], f"{describe_window(rolling[0])} rolling time in target zone (%)")
+    renderer = get_plot_renderer(TimeInZonePlotRenderer, config)
+    renderer.render(output_file, title, config, time_data, time_in_tz, overlay, coverage=coverage, notes_window=notes_window)
 
-        fig, ax = plt.subplots()
-        fig.suptitle(title + f" (all-time average: {avg_tz_time:.1f}%)")
-        ax.set_xlabel("Date")
-        ax.set_ylabel("Time in target zone (%)")
-        ax.set_yticks(np.arange(0, 100, 5))
-        fig.autofmt_xdate()
 
-        ax.plot(time_data, time_in_tz, 'k.-', label="Time in target zone (%)")
+@timed('agp_plot')
+def generate_agp_plot_from_data(output_file, title, config, time_of_day, percentiles, days):
+    """
+    Plots an ambulatory glucose profile from graphify_agp_data().
+    """
+    renderer = get_plot_renderer(AgpPlotRenderer, config)
+    renderer.render(output_file, title + f" ({days} days of data)", config, time_of_day, percentiles)
 
-        # draw target zone
-        plt.axhline(y=config.time_in_tz_max, color='green', linestyle='--')
-        plt.axhline(y=config.time_in_tz_min, color='orange', linestyle='--')
-        plt.axhline(y=config.time_in_tz_warn, color='red', linestyle='--')
-        (xlim_min, xlim_max) = ax.get_xbound()
-        (ylim_min, ylim_max) = ax.get_ybound()
-        plt.fill((xlim_min, xlim_max, xlim_max, xlim_min), (config.time_in_tz_min, config.time_in_tz_min, config.time_in_tz_max, config.time_in_tz_max), 'palegreen')
-        plt.fill((xlim_min, xlim_max, xlim_max, xlim_min), (config.time_in_tz_warn, config.time_in_tz_warn, config.time_in_tz_min, config.time_in_tz_min), 'palegoldenrod')
-
-        # draw labeled notes if present
-        for note in config.notes:
-            logging.info(f"Annotating datetime {note['datetime']} with text '{note['text']}'")
-            ax.annotate(
-                note['text'], (note['datetime'], ylim_min),
-                xytext=(90, -20), textcoords='offset pixels',
-                arrowprops=dict(facecolor='red', width=0.1, headwidth=4, headlength=4),
-                fontsize=7,
-                horizontalalignment='right', verticalalignment='top',
-            )
-
-        legend = ax.legend()
-        plt.savefig(output_file)
-
-def generate_weekly_reports(config, data):
+
+def plan_weekly_reports(config, data):
+    """
+    Returns a list of (output_file, title, start_date) for every week from
+    the week of the first reading through the last reading.
+    """
     time_data, glucose = graphify_glucose_data(data)
+    if len(time_data) == 0:
+        return []
     # find the starting day of the same week as the first data point
     # first, get the minimum time on the same day
-    first_day = datetime.datetime.combine(time_data[0].date(), datetime.time().min)
+    first_day = datetime.datetime.combine(time_data[0].item().date(), datetime.time().min)
     while first_day.weekday() != config.weeks_start_on:
         first_day = first_day - datetime.timedelta(days=1)
 
-    # now, generate each week
+    # now, plan each week
     reports = []
-    while first_day < time_data[-1]:
+    while first_day < time_data[-1].item():
         daystr = date_to_output(first_day)
-        logging.info("Generating graph for week starting {daystr}")
         output_file = os.path.join(config.reports_dir, f"{daystr}_weekly.png")
-        reports.append(output_file)
-        generate_one_week_report(output_file, f"Blood Glucose Levels for the week starting {daystr}", config, data, first_day)
+        reports.append((output_file, f"Blood Glucose Levels for the week starting {daystr}", first_day))
         first_day = first_day + datetime.timedelta(weeks=1)
+    return reports
 
+
+def coverage_report(config, data):
+    """
+    Returns the gaps in the data (see find_gaps()) and how much of every day
+    and week has data (see coverage_from_index()), for coverage.json.
+    Weeks are the ones the weekly graphs use.
+    """
+    time_data, glucose = graphify_glucose_data(data)
+    report = {'max_gap_minutes': config.max_gap_minutes, 'gaps': [], 'daily': [], 'weekly': []}
+    if len(time_data) == 0:
+        return report
+    for start, end in zip(*find_gaps(time_data, max_gap_seconds(config))):
+        report['gaps'].append({'start': str(epoch_to_datetime(start)), 'end': str(epoch_to_datetime(end)), 'hours': (end - start) / 3600})
+
+    tz_index = get_time_in_target_index(config, data)
+    first_day = time_data[0].astype('datetime64[D]')
+    days = np.arange(first_day, time_data[-1].astype('datetime64[D]') + 1)
+    day_start = days.astype('datetime64[s]').astype(np.int64)
+    for day, coverage in zip(days.tolist(), coverage_from_index(tz_index, day_start, day_start + 86400).tolist()):
+        report['daily'].append({'date': str(day), 'coverage': coverage * 100})
+    week_start = [start_date for output_file, title, start_date in plan_weekly_reports(config, data)]
+    week_seconds = np.array([datetime_to_epoch(start_date) for start_date in week_start], dtype=np.float64)
+    for start_date, coverage in zip(week_start, coverage_from_index(tz_index, week_seconds, week_seconds + 7 * 86400).tolist()):
+        report['weekly'].append({'week_starting': str(start_date.date()), 'coverage': coverage * 100})
+    return report
+
+
+def glucose_metrics(config, data, current_datetime):
+    """
+    Returns the time in zones and glucose statistics for all time and the
+    same recent ranges the graphs cover, for --metrics-only.  Percentages
+    are of the time that has data, like on the graphs, and statistics that
+    can't be calculated (no data) are None.
+    """
+    valid = data['glucose'] != GLUCOSE_MISSING
+    time_data = data['time'][valid]
+    glucose = data['glucose'][valid]
+    tz_index = get_time_in_target_index(config, data)
+    stats_index = build_glucose_stats_index(time_data, glucose, max_gap_seconds(config))
+
+    def number(value, scale=1.0):
+        value = float(value) * scale
+        return None if np.isnan(value) else round(value, 2)
+
+    metrics = {
+        'target_min': config.target_min,
+        'target_max': config.target_max,
+        'max_gap_minutes': config.max_gap_minutes,
+    }
+    if len(time_data) == 0:
+        return metrics
+    now = datetime_to_epoch(current_datetime)
+    for name, length in (("all-time", None), ("last-year", datetime.timedelta(weeks=52)), ("last-6mo", datetime.timedelta(weeks=26)), ("last-14d", datetime.timedelta(days=14))):
+        start, end = (float(time_data[0]), float(time_data[-1])) if length is None else (now - length.total_seconds(), now)
+        in_zone, below, above = time_in_zones_from_index(tz_index, start, end)
+        stats = glucose_stats_from_index(stats_index, start, end, min_coverage=0.0)
+        metrics[name] = {
+            'start': str(epoch_to_datetime(start)),
+            'end': str(epoch_to_datetime(end)),
+            'readings': int(np.searchsorted(time_data, end, side='right') - np.searchsorted(time_data, start, side='left')),
+            'coverage': number(coverage_from_index(tz_index, start, end), 100),
+            'time_in_target': number(in_zone, 100),
+            'time_below_target': number(below, 100),
+            'time_above_target': number(above, 100),
+            'mean': number(stats['mean']),
+            'sd': number(stats['sd']),
+            'cv': number(stats['cv']),
+            'gmi': number(stats['gmi']),
+        }
+    return metrics
+
+
+def generate_index(config, reports):
+    """
+    Writes index.html into the reports dir, given the list of weekly report
+    files.
+    """
     # generate the index file
     # TODO: this should be extracted out and generate based on what files are
     # present so it can include all graphs.  For now we will hardcode the
@@ -572,6 +2915,10 @@ def generate_weekly_reports(config, data):
         f.write("<p>")
         f.write(f"<img src=\"all-time-weeklytz-graph.png\"/>")
         f.write("</p>")
+        f.write("\t<h1>All-Time Ambulatory Glucose Profile</h1>")
+        f.write("<p>")
+        f.write(f"<img src=\"all-time-agp-graph.png\"/>")
+        f.write("</p>")
 
         # last year reports
         f.write("\t<h1>Last Year Glucose Levels</h1>")
@@ -586,6 +2933,10 @@ def generate_weekly_reports(config, data):
         f.write("<p>")
         f.write(f"<img src=\"last-year-weeklytz-graph.png\"/>")
         f.write("</p>")
+        f.write("\t<h1>Last Year Ambulatory Glucose Profile</h1>")
+        f.write("<p>")
+        f.write(f"<img src=\"last-year-agp-graph.png\"/>")
+        f.write("</p>")
 
         # last 6mo reports
         f.write("\t<h1>Last Six Month Glucose Levels</h1>")
@@ -600,6 +2951,16 @@ def generate_weekly_reports(config, data):
         f.write("<p>")
         f.write(f"<img src=\"last-6mo-weeklytz-graph.png\"/>")
         f.write("</p>")
+        f.write("\t<h1>Last Six Month Ambulatory Glucose Profile</h1>")
+        f.write("<p>")
+        f.write(f"<img src=\"last-6mo-agp-graph.png\"/>")
+        f.write("</p>")
+
+        # last 14 days reports
+        f.write("\t<h1>Last 14 Day Ambulatory Glucose Profile</h1>")
+        f.write("<p>")
+        f.write(f"<img src=\"last-14d-agp-graph.png\"/>")
+        f.write("</p>")
 
         # weekly reports
         f.write("\t<h1>Weekly Blood Glucose Reports</h1>")
@@ -616,28 +2977,41 @@ def generate_time_range_glucose_report(output_file, title, config, data, start_d
     Given the already-parsed data, generate a graph of the data for an arbitrary range of time
     """
     time_data, glucose = graphify_glucose_data(data, start_date=start_date, end_date=end_date)
-    generate_glucose_plot_from_data(output_file, title, config, time_data, glucose)
+    generate_glucose_plot_from_data(output_file, title, config, time_data, glucose, downsample=not config.full_resolution, rolling_window=datetime.timedelta(days=7), tz_index=get_time_in_target_index(config, data), notes_window=dataset_time_window(data, start_date, end_date))
+
+def generate_time_range_agp_report(output_file, title, config, data, start_date, end_date):
+    """
+    Given the already-parsed data, generate an ambulatory glucose profile for an arbitrary range of time
+    """
+    time_of_day, percentiles, days = graphify_agp_data(data, start_date=start_date, end_date=end_date)
+    generate_agp_plot_from_data(output_file, title, config, time_of_day, percentiles, days)
 
 def generate_time_range_tz_report(output_file, title, config, data, start_date, end_date):
     """
     Given the already-parsed data, generate a graph of the data for an arbitrary range of time
     """
     time_data, tz_data = graphify_time_in_tz_data(config, data, start_date, end_date)
-    generate_time_in_tz_plot_from_data(output_file, title, config, time_data, tz_data)
+    rolling = graphify_rolling_time_in_tz_data(config, data, start_date, end_date)
+    coverage = graphify_coverage_data(config, data, start_date, end_date)
+    generate_time_in_tz_plot_from_data(output_file, title, config, time_data, tz_data, rolling, coverage, dataset_time_window(data, start_date, end_date))
 
 def generate_time_range_weekly_tz_report(output_file, title, config, data, start_date, end_date):
     """
     Given the already-parsed data, generate a graph of the data for an arbitrary range of time
     """
     time_data, tz_data = graphify_time_in_tz_data(config, data, start_date, end_date, datetime.timedelta(weeks=1))
-    generate_time_in_tz_plot_from_data(output_file, title, config, time_data, tz_data)
+    rolling = graphify_rolling_time_in_tz_data(config, data, start_date, end_date, datetime.timedelta(weeks=1), datetime.timedelta(weeks=4))
+    coverage = graphify_coverage_data(config, data, start_date, end_date, datetime.timedelta(weeks=1))
+    generate_time_in_tz_plot_from_data(output_file, title, config, time_data, tz_data, rolling, coverage, dataset_time_window(data, start_date, end_date))
 
 def generate_one_week_report(output_file, title, config, data, start_date):
     """
     Given the already-parsed data, and a starting date, generate a graph of the data for the week starting at the given date.
     """
-    time_data, glucose = graphify_glucose_data(data, start_date=start_date, end_date=(start_date + datetime.timedelta(weeks=1)))
-    generate_glucose_plot_from_data(output_file, title, config, time_data, glucose)
+    logging.info(f"Generating graph for week starting {date_to_output(start_date)}")
+    end_date = start_date + datetime.timedelta(weeks=1)
+    time_data, glucose = graphify_glucose_data(data, start_date=start_date, end_date=end_date)
+    generate_glucose_plot_from_data(output_file, title, config, time_data, glucose, rolling_window=datetime.timedelta(days=1), tz_index=get_time_in_target_index(config, data), notes_window=dataset_time_window(data, start_date, end_date))
 
 
 def generate_all_time_glucose_plot(output_file, config, data):
@@ -646,7 +3020,15 @@ def generate_all_time_glucose_plot(output_file, config, data):
     """
     # first, produce data we can easily plot
     time_data, glucose = graphify_glucose_data(data)
-    generate_glucose_plot_from_data(output_file, "All-Time Blood Glucose Levels", config, time_data, glucose)
+    generate_glucose_plot_from_data(output_file, "All-Time Blood Glucose Levels", config, time_data, glucose, downsample=not config.full_resolution, rolling_window=datetime.timedelta(weeks=4), tz_index=get_time_in_target_index(config, data), notes_window=dataset_time_window(data))
+
+
+def generate_all_time_agp_plot(output_file, config, data):
+    """
+    Given the already-parsed data, generate an ambulatory glucose profile of all time
+    """
+    time_of_day, percentiles, days = graphify_agp_data(data)
+    generate_agp_plot_from_data(output_file, "All-Time Ambulatory Glucose Profile", config, time_of_day, percentiles, days)
 
 
 def generate_weekly_tz_plot(output_file, config, data):
@@ -655,7 +3037,9 @@ def generate_weekly_tz_plot(output_file, config, data):
     """
     # first, produce data we can easily plot
     time_data, tz_data = graphify_time_in_tz_data(config, data, None, None, datetime.timedelta(weeks=1))
-    generate_time_in_tz_plot_from_data(output_file, "All-Time Weekly Percentage Time in Target Zone", config, time_data, tz_data)
+    rolling = graphify_rolling_time_in_tz_data(config, data, None, None, datetime.timedelta(weeks=1), datetime.timedelta(weeks=4))
+    coverage = graphify_coverage_data(config, data, None, None, datetime.timedelta(weeks=1))
+    generate_time_in_tz_plot_from_data(output_file, "All-Time Weekly Percentage Time in Target Zone", config, time_data, tz_data, rolling, coverage, dataset_time_window(data))
 
 
 def generate_all_time_tz_plot(output_file, config, data):
@@ -664,47 +3048,128 @@ def generate_all_time_tz_plot(output_file, config, data):
     """
     # first, produce data we can easily plot
     time_data, tz_data = graphify_time_in_tz_data(config, data)
-    generate_time_in_tz_plot_from_data(output_file, "All-Time Daily Percentage Time in Target Zone", config, time_data, tz_data)
+    rolling = graphify_rolling_time_in_tz_data(config, data)
+    coverage = graphify_coverage_data(config, data)
+    generate_time_in_tz_plot_from_data(output_file, "All-Time Daily Percentage Time in Target Zone", config, time_data, tz_data, rolling, coverage, dataset_time_window(data))
 
 
-if __name__ == '__main__':
+def build_arg_parser():
     ap = argparse.ArgumentParser()
     ap.add_argument('--target-min',
             help='Minimum Target Zone for Blood Glucose Level (in mg/dL)',
+            type=float,
             default=70,
     )
 
     ap.add_argument('--target-max',
             help='Maximum Target Zone for Blood Glucose Level (in mg/dL)',
+            type=float,
             default=180,
     )
     ap.add_argument('--time-in-tz-min',
             help='Minimum expected time in target zone in percent (e.g. 80.0)',
+            type=float,
             default=80.0,
     )
     ap.add_argument('--time-in-tz-max',
             help='Maximum expected time in target zone in percent (e.g. 100.0)',
+            type=float,
             default=100.0,
     )
     ap.add_argument('--time-in-tz-warn',
             help='Second best minimum expected time in target zone in percent (e.g. 70.0)',
+            type=float,
             default=70.0,
     )
     ap.add_argument('--weeks-start-on',
             help='Day of the week that weekly graphs start on (0=monday, 6=sunday)',
+            type=int,
+            choices=range(7),
             default=6,
     )
+    ap.add_argument('--max-gap-minutes',
+            help='Readings further apart than this are a gap in the data, which is left out of the time in target and statistics instead of interpolated across (0 to never)',
+            type=float,
+            default=DEFAULT_MAX_GAP_SECONDS / 60,
+    )
     ap.add_argument('--notes-data',
             help='Notes/Labels to annotate graphs (in JSON format)',
             nargs='+',
     )
 
+    ap.add_argument('--incremental',
+            help='Carry forward graphs from the previous run in reports/ whose data, notes and thresholds have not changed',
+            action='store_true',
+    )
+    ap.add_argument('--full-resolution',
+            help='Draw every reading on the all-time and long range graphs instead of just the lows and highs per pixel',
+            action='store_true',
+    )
+    ap.add_argument('--metrics-only', '--json',
+            help='Just print the time in target and glucose statistics as JSON instead of generating any reports',
+            action='store_true',
+    )
+    ap.add_argument('--output-dir',
+            help='Where to write the reports, each run into a new timestamped directory (default: reports/ in the current directory)',
+    )
+    ap.add_argument('--batch',
+            help='Generate reports for many patients in one run instead of --cgm-data: a directory with one subdirectory of exports per patient, or a JSON manifest of patients (see README)',
+    )
+    ap.add_argument('--workers',
+            help='How many worker processes to render graphs with (default: one per CPU)',
+            type=int,
+    )
+    ap.add_argument('--profile',
+            help='Run each graph under cProfile and dump the stats to profiles/ in the reports dir',
+            action='store_true',
+    )
+    ap.add_argument('--streaming',
+            help='Merge the CGM data files straight from disk a chunk at a time and keep only the readings, for exports too big to load whole (files must be in time order, the parse cache is not used for them)',
+            action='store_true',
+    )
+    ap.add_argument('--watch',
+            help='Keep running after generating the reports, and update them whenever the CGM data files grow or new ones appear in a --cgm-data directory',
+            action='store_true',
+    )
+    ap.add_argument('--watch-interval',
+            help='How often to check for new CGM data in --watch mode (in seconds)',
+            type=float,
+            default=30.0,
+    )
+    ap.add_argument('--store',
+            help='SQLite file to keep the CGM history in: --cgm-data files are imported into it (readings already there are skipped) and the reports cover everything in it, so old exports don\'t have to be passed again',
+    )
+    ap.add_argument('--cache-dir',
+            help='Where to keep parsed copies of the input files (default: ~/.cache/glucose-tools)',
+    )
+    ap.add_argument('--no-cache',
+            help='Parse every input file from scratch without reading or writing the cache',
+            action='store_true',
+    )
+    ap.add_argument('--rebuild-cache',
+            help='Parse every input file from scratch and replace its cache entry',
+            action='store_true',
+    )
+
     required = ap.add_argument_group('required arguments')
     required.add_argument('--cgm-data',
-            help='Continuous Glucose Monitoring (CGM) data file(s) (in libreview CSV format)',
+            help='Continuous Glucose Monitoring (CGM) data file(s) (in libreview CSV format), or directories of them',
             nargs='+',
     )
 
+    return ap
+
+
+if __name__ == '__main__':
+    ap = build_arg_parser()
     config = ap.parse_args()
+    if config.batch and (config.cgm_data or config.notes_data or config.watch):
+        ap.error("--batch takes the data files from the batch, and can't be used with --cgm-data, --notes-data or --watch")
+    if config.metrics_only and (config.batch or config.watch):
+        ap.error("--metrics-only can't be used with --batch or --watch")
+    if config.store and (config.batch or config.watch or config.streaming):
+        ap.error("--store can't be used with --batch, --watch or --streaming")
+    if not config.batch and not config.store and not config.cgm_data:
+        ap.error("--cgm-data is required (unless using --batch or --store)")
 
     main(config)
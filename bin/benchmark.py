@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import analyze  # noqa: E402
+
+import numpy as np  # noqa: E402
+
+# name -> days of data.  Always generated with the same seed so results
+# are comparable between runs and machines.
+DATASETS = {
+    '1mo': 30,
+    '1yr': 365,
+    '10yr': 3650,
+}
+DATASET_SEED = 1
+DATASET_START = '2012-01-01'
+
+
+def dataset_path(config, name):
+    """
+    Returns the csv for the named dataset, generating it if needed.
+    """
+    path = os.path.join(config.data_dir, f"{name}-seed{DATASET_SEED}.csv")
+    if not os.path.exists(path):
+        logging.info(f"Generating {name} dataset at {path}")
+        os.makedirs(config.data_dir, exist_ok=True)
+        subprocess.run([
+            sys.executable, os.path.join(REPO_DIR, "bin", "generate-data.py"), path,
+            '--days', str(DATASETS[name]),
+            '--seed', str(DATASET_SEED),
+            '--start-date', DATASET_START,
+        ], check=True, stderr=subprocess.DEVNULL)
+    return path
+
+
+def time_it(config, function):
+    """
+    Runs function config.repeat times, returns the timings in seconds.
+    """
+    timings = []
+    for i in range(config.repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def bench_parse_csv(config, csv_file, work_dir):
+    return time_it(config, lambda: analyze.load_cgm_data([csv_file]))
+
+
+def bench_graphify_glucose(config, csv_file, work_dir):
+    data = analyze.load_cgm_data([csv_file])
+    return time_it(config, lambda: analyze.graphify_glucose_data(data))
+
+
+def bench_graphify_tz_daily(config, csv_file, work_dir):
+    report_config = report_config_for(csv_file, work_dir)
+    data = analyze.load_cgm_data([csv_file])
+
+    def run():
+        # the index is built once per dataset in main(), so count it here
+        data.pop('tz_index', None)
+        analyze.graphify_time_in_tz_data(report_config, data)
+    return time_it(config, run)
+
+
+def bench_graphify_tz_weekly(config, csv_file, work_dir):
+    report_config = report_config_for(csv_file, work_dir)
+    data = analyze.load_cgm_data([csv_file])
+
+    def run():
+        data.pop('tz_index', None)
+        analyze.graphify_time_in_tz_data(report_config, data, interval=datetime.timedelta(weeks=1))
+    return time_it(config, run)
+
+
+def bench_graphify_agp(config, csv_file, work_dir):
+    data = analyze.load_cgm_data([csv_file])
+    return time_it(config, lambda: analyze.graphify_agp_data(data))
+
+
+def bench_glucose_plot(config, csv_file, work_dir):
+    report_config = report_config_for(csv_file, work_dir)
+    data = analyze.load_cgm_data([csv_file])
+    time_data, glucose = analyze.graphify_glucose_data(data)
+    output_file = os.path.join(work_dir, "glucose-plot.png")
+    return time_it(config, lambda: analyze.generate_glucose_plot_from_data(output_file, "Benchmark", report_config, time_data, glucose))
+
+
+def bench_full_run(config, csv_file, work_dir):
+    # run the real thing in a fresh interpreter, the way a user would
+    command = [sys.executable, os.path.join(REPO_DIR, "analyze.py"), '--cgm-data', csv_file, '--no-cache']
+    return time_it(config, lambda: subprocess.run(command, cwd=work_dir, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+
+
+BENCHMARKS = {
+    'parse_csv': bench_parse_csv,
+    'graphify_glucose': bench_graphify_glucose,
+    'graphify_tz_daily': bench_graphify_tz_daily,
+    'graphify_tz_weekly': bench_graphify_tz_weekly,
+    'graphify_agp': bench_graphify_agp,
+    'glucose_plot': bench_glucose_plot,
+    'full_run': bench_full_run,
+}
+
+
+def report_config_for(csv_file, work_dir):
+    """
+    Returns the config analyze.py would use with all the default options.
+    """
+    report_config = analyze.build_arg_parser().parse_args(['--cgm-data', csv_file, '--no-cache'])
+    report_config.notes = analyze.NotesIndex([])
+    report_config.reports_dir = work_dir
+    return report_config
+
+
+def environment():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        revision = None
+    return {
+        'date': datetime.datetime.now().isoformat(),
+        'revision': revision,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints how results compare to a baseline to stderr (stdout may be the
+    results JSON), returns the list of benchmarks that got slower by more
+    than threshold (a ratio, e.g. 0.1 = 10%).
+    """
+    regressions = []
+    print(f"{'benchmark':<30} {'baseline':>10} {'current':>10} {'change':>8}", file=sys.stderr)
+    for key, result in sorted(results.items()):
+        if key not in baseline['results']:
+            print(f"{key:<30} {'-':>10} {result['min']:>10.4f} {'new':>8}", file=sys.stderr)
+            continue
+        old = baseline['results'][key]['min']
+        change = (result['min'] - old) / old if old else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(key)
+        print(f"{key:<30} {old:>10.4f} {result['min']:>10.4f} {change*100:>7.1f}%{flag}", file=sys.stderr)
+    return regressions
+
+
+def main(config):
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.INFO)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name in config.datasets:
+            csv_file = dataset_path(config, name)
+            for benchmark in config.benchmarks:
+                # analyze.py logs a lot at DEBUG, which would skew timings
+                logging.getLogger().setLevel(logging.WARNING)
+                timings = BENCHMARKS[benchmark](config, csv_file, work_dir)
+                logging.getLogger().setLevel(logging.INFO)
+                key = f"{name}/{benchmark}"
+                results[key] = {
+                    'min': min(timings),
+                    'median': statistics.median(timings),
+                    'runs': timings,
+                }
+                logging.info(f"{key}: min {min(timings):.4f}s median {statistics.median(timings):.4f}s")
+
+    output = {'environment': environment(), 'results': results}
+    if config.output:
+        with open(config.output, 'w') as f:
+            json.dump(output, f, indent=1)
+    else:
+        json.dump(output, sys.stdout, indent=1)
+        print()
+
+    if config.compare:
+        with open(config.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, config.threshold)
+        if regressions:
+            logging.error(f"{len(regressions)} benchmark(s) regressed by more than {config.threshold*100:.0f}%: {', '.join(regressions)}")
+            sys.exit(1)
+    sys.exit(0)
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='Benchmark analyze.py on synthetic datasets')
+    ap.add_argument('--datasets',
+            help='Which dataset sizes to run',
+            nargs='+',
+            choices=list(DATASETS),
+            default=list(DATASETS),
+    )
+    ap.add_argument('--benchmarks',
+            help='Which benchmarks to run',
+            nargs='+',
+            choices=list(BENCHMARKS),
+            default=list(BENCHMARKS),
+    )
+    ap.add_argument('--repeat',
+            help='How many times to run each benchmark (the fastest run is what gets compared)',
+            type=int,
+            default=3,
+    )
+    ap.add_argument('--data-dir',
+            help='Where to keep the generated datasets',
+            default=os.path.join(tempfile.gettempdir(), "glucose-tools-bench"),
+    )
+    ap.add_argument('--output',
+            help='Write the JSON results to this file instead of stdout',
+    )
+    ap.add_argument('--compare',
+            help='Baseline JSON results to compare against, exits non-zero on regressions',
+    )
+    ap.add_argument('--threshold',
+            help='How much slower (as a ratio, 0.2 = 20%%) a benchmark can get before it counts as a regression',
+            type=float,
+            default=0.2,
+    )
+
+    config = ap.parse_args()
+
+    main(config)
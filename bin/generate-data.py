@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 
+import argparse
 import csv
-import dateutil
+import datetime
+import getpass
 import logging
+import math
 import os
-import pprint
+import random
 import sys
 
 HEADER_ORDER = [
@@ -51,6 +54,29 @@ BUILT_IN_HEADERS = {
     'User Change Insulin (units)': 'user_change_insulin',
 }
 
+# libreview record types
+RECORD_TYPE_HISTORIC = 0
+RECORD_TYPE_SCAN = 1
+RECORD_TYPE_INSULIN = 4
+RECORD_TYPE_FOOD = 5
+RECORD_TYPE_NOTES = 6
+
+DEVICE_TIMESTAMP_FORMAT = "%m-%d-%Y %I:%M %p"
+
+# a libre sensor lasts 14 days, then there is a warm up period
+SENSOR_DAYS = 14
+SENSOR_WARMUP = datetime.timedelta(hours=1)
+
+NOTES = [
+    'Went for a run',
+    'Felt shaky',
+    'Pizza night',
+    'Long hike',
+    'Stressful day at work',
+    'Slept badly',
+    'Forgot to take meds',
+]
+
 """
 Example row:
 [{'carbs_g': '',
@@ -73,25 +99,278 @@ Example row:
   'type': '0',
   'user_change_insulin': ''}]
 """
-def main():
-    print(f"File to output: {sys.argv[1]}")
 
 
-    time = []
-    data = {}
-    config = {
-        'target_min':70,
-        'target_max':180,
-    }
+def day_random(config, day, what):
+    """
+    Returns a random number generator that only depends on the seed, the
+    day and what it is used for.  This is what makes overlapping exports
+    contain exactly the same rows for the days they share, without having
+    to keep anything from earlier days around.
+    """
+    return random.Random(f"{config.seed}-{day.isoformat()}-{what}")
+
+
+def plan_meals(config, day):
+    """
+    Returns a list of (datetime, carbs in grams) for the meals eaten on day.
+    """
+    rng = day_random(config, day, 'meals')
+    meals = []
+    for hour, carbs in ((7.5, 45), (12.5, 60), (18.5, 75)):
+        if rng.random() < 0.08:
+            # skipped a meal
+            continue
+        when = datetime.datetime.combine(day, datetime.time()) + datetime.timedelta(hours=rng.gauss(hour, 0.75))
+        meals.append((when, max(5, int(rng.gauss(carbs, carbs * 0.35)))))
+    if rng.random() < 0.3:
+        # late night snack
+        when = datetime.datetime.combine(day, datetime.time()) + datetime.timedelta(hours=rng.uniform(21, 23.5))
+        meals.append((when, int(rng.uniform(10, 40))))
+    return sorted(meals)
+
+
+def plan_gaps(config, day):
+    """
+    Returns a list of (start, end) datetimes on day where the sensor has no
+    data: sensor changes, and the sensor falling off or losing signal.
+    """
+    rng = day_random(config, day, 'gaps')
+    midnight = datetime.datetime.combine(day, datetime.time())
+    gaps = []
+    if (day - config.start_date).days % SENSOR_DAYS == 0:
+        start = midnight + datetime.timedelta(hours=rng.uniform(8, 20))
+        gaps.append((start, start + SENSOR_WARMUP))
+    if rng.random() < config.gap_probability:
+        start = midnight + datetime.timedelta(hours=rng.uniform(0, 24))
+        gaps.append((start, start + datetime.timedelta(hours=rng.uniform(0.5, 8))))
+    return gaps
+
+
+def sensor_offset(config, day):
+    """
+    Each sensor starts at a random minute, which every historic reading is
+    then aligned to.
+    """
+    sensor = (day - config.start_date).days // SENSOR_DAYS
+    return day_random(config, config.start_date + datetime.timedelta(days=sensor * SENSOR_DAYS), 'sensor').randrange(config.interval)
+
+
+def meal_response(minutes, carbs):
+    """
+    Glucose rise (mg/dL) from a meal eaten the given minutes ago, peaking
+    about 50 minutes after eating and back to baseline after ~4 hours.
+    """
+    if minutes <= 0 or minutes > 300:
+        return 0.0
+    shape = (minutes / 50.0) * math.exp(1 - minutes / 50.0)
+    return carbs * 1.3 * shape
+
+
+class GlucoseModel:
+    """
+    Deterministic glucose curve for a given seed: baseline, circadian
+    (including the dawn phenomenon), meals and slow random drift.
+    """
+    def __init__(self, config):
+        self.config = config
+        rng = random.Random(f"{config.seed}-drift")
+        # slow drift as a sum of sine waves with random phases, so it is
+        # smooth and can be evaluated at any time without any state
+        self.drift = [(rng.uniform(5, 15), 2 * math.pi / (rng.uniform(2, 36) * 3600), rng.uniform(0, 2 * math.pi)) for _ in range(6)]
+        self.meals = {}
+
+    def meals_for(self, day):
+        if day not in self.meals:
+            self.meals[day] = plan_meals(self.config, day)
+            # only ever need today and yesterday
+            for old in [d for d in self.meals if d < day - datetime.timedelta(days=1)]:
+                del self.meals[old]
+        return self.meals[day]
+
+    def glucose_at(self, when):
+        hours = when.hour + when.minute / 60.0
+        seconds = (when - datetime.datetime(1970, 1, 1)).total_seconds()
+        glucose = self.config.baseline
+        # circadian: a bit lower in the afternoon, dawn phenomenon around 6am
+        glucose += 8 * math.sin(2 * math.pi * (hours - 9) / 24)
+        glucose += 20 * math.exp(-((hours - 6.5) ** 2) / 2)
+        for amplitude, frequency, phase in self.drift:
+            glucose += amplitude * math.sin(frequency * seconds + phase)
+        for day in (when.date() - datetime.timedelta(days=1), when.date()):
+            for meal_time, carbs in self.meals_for(day):
+                glucose += meal_response((when - meal_time).total_seconds() / 60.0, carbs)
+        return max(40, min(400, int(round(glucose))))
 
-    # TODO: generate data
 
-    with open(sys.argv[1], 'w') as f:
-        curdate = '03-29-2022 03:19 AM UTC'
-        f.write(f"Glucose Data,Generated on,{curdate},Generated by,{os.getlogin()}\n")
-        f.write(HEADER_ORDER.join(","), "\n")
-        # TODO: write csv data
+def make_row(config, when, record_type, **values):
+    row = dict((name, '') for name in BUILT_IN_HEADERS.values())
+    row['device'] = config.device
+    row['sn'] = config.serial
+    row['timestamp'] = when.strftime(DEVICE_TIMESTAMP_FORMAT)
+    row['type'] = str(record_type)
+    for key, value in values.items():
+        row[key] = str(value)
+    return [row[BUILT_IN_HEADERS[header]] for header in HEADER_ORDER]
+
+
+def generate_day(config, model, day):
+    """
+    Returns all the csv rows for one day, sorted by time.
+    """
+    rng = day_random(config, day, 'events')
+    midnight = datetime.datetime.combine(day, datetime.time())
+    gaps = plan_gaps(config, day)
+
+    def in_gap(when):
+        return any(start <= when < end for start, end in gaps)
+
+    rows = []
+    # historic readings every interval minutes
+    when = midnight + datetime.timedelta(minutes=sensor_offset(config, day))
+    while when.date() == day:
+        if not in_gap(when):
+            rows.append((when, RECORD_TYPE_HISTORIC, make_row(config, when, RECORD_TYPE_HISTORIC, historic_glucose=model.glucose_at(when))))
+        when += datetime.timedelta(minutes=config.interval)
+
+    # scans, a few times a day at random
+    for i in range(int(rng.gauss(config.scans_per_day, 2))):
+        when = midnight + datetime.timedelta(minutes=rng.randrange(24 * 60))
+        if not in_gap(when):
+            rows.append((when, RECORD_TYPE_SCAN, make_row(config, when, RECORD_TYPE_SCAN, glucose=model.glucose_at(when))))
+
+    # food and insulin with each meal
+    for when, carbs in model.meals_for(day):
+        when = when.replace(second=0, microsecond=0)
+        rows.append((when, RECORD_TYPE_FOOD, make_row(config, when, RECORD_TYPE_FOOD, carbs_g=carbs)))
+        if config.insulin:
+            rows.append((when, RECORD_TYPE_INSULIN, make_row(config, when, RECORD_TYPE_INSULIN, rai_units=max(1, round(carbs / 10)))))
+    if config.insulin:
+        when = midnight + datetime.timedelta(hours=22, minutes=rng.randrange(60))
+        rows.append((when, RECORD_TYPE_INSULIN, make_row(config, when, RECORD_TYPE_INSULIN, lai_units=20)))
+
+    # the odd note
+    if rng.random() < config.note_probability:
+        when = midnight + datetime.timedelta(minutes=rng.randrange(24 * 60))
+        rows.append((when, RECORD_TYPE_NOTES, make_row(config, when, RECORD_TYPE_NOTES, notes=rng.choice(NOTES))))
+
+    rows.sort(key=lambda row: (row[0], row[1]))
+    return [row for when, record_type, row in rows]
+
+
+def write_export(config, output_file, first_day, last_day):
+    """
+    Writes one libreview export covering first_day through last_day,
+    streaming a day at a time so memory doesn't grow with the file.
+    """
+    logging.info(f"Writing {first_day} through {last_day} to {output_file}")
+    model = GlucoseModel(config)
+    with open(output_file, 'w', newline='') as f:
+        curdate = datetime.datetime.combine(last_day, datetime.time(23, 59)).strftime(DEVICE_TIMESTAMP_FORMAT) + " UTC"
+        f.write(f"Glucose Data,Generated on,{curdate},Generated by,{config.generated_by}\n")
+        f.write(",".join(HEADER_ORDER) + "\n")
+        writer = csv.writer(f, lineterminator="\n")
+        day = first_day
+        while day <= last_day:
+            writer.writerows(generate_day(config, model, day))
+            day += datetime.timedelta(days=1)
+
+
+def main(config):
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.INFO)
+
+    if config.seed is None:
+        config.seed = random.randrange(1 << 32)
+        logging.info(f"Using seed {config.seed}")
+    if config.serial is None:
+        config.serial = str(random.Random(f"{config.seed}-serial").getrandbits(128).to_bytes(16, 'big').hex())
+    config.start_date = datetime.datetime.strptime(config.start_date, "%Y-%m-%d").date()
+    last_day = config.start_date + datetime.timedelta(days=config.days - 1)
+
+    if config.exports <= 1:
+        write_export(config, config.output_file, config.start_date, last_day)
+        sys.exit(0)
+
+    # split the range into exports that each overlap the one before, like
+    # exporting from libreview every month or so
+    base, ext = os.path.splitext(config.output_file)
+    span = math.ceil(config.days / config.exports)
+    for export in range(config.exports):
+        first_day = config.start_date + datetime.timedelta(days=max(0, export * span - config.overlap_days))
+        export_last_day = min(last_day, config.start_date + datetime.timedelta(days=(export + 1) * span - 1))
+        write_export(config, f"{base}-{export + 1:03d}{ext}", first_day, export_last_day)
     sys.exit(0)
 
 if __name__ == '__main__':
-    main()
+    ap = argparse.ArgumentParser(description='Generate synthetic libreview CGM exports')
+    ap.add_argument('output_file',
+            help='CSV file to write (with --exports, a number is added to the name of each file)',
+    )
+    ap.add_argument('--days',
+            help='Number of days of data to generate',
+            type=int,
+            default=90,
+    )
+    ap.add_argument('--start-date',
+            help='First day of data (YYYY-MM-DD)',
+            default='2021-01-03',
+    )
+    ap.add_argument('--seed',
+            help='Random seed, the same seed always generates the same data',
+            type=int,
+    )
+    ap.add_argument('--interval',
+            help='Minutes between historic readings',
+            type=int,
+            default=15,
+    )
+    ap.add_argument('--baseline',
+            help='Fasting glucose level to wander around (in mg/dL)',
+            type=float,
+            default=115.0,
+    )
+    ap.add_argument('--scans-per-day',
+            help='Average number of scans per day',
+            type=float,
+            default=6.0,
+    )
+    ap.add_argument('--gap-probability',
+            help='Chance of a sensor gap (0.5 to 8 hours) on any given day',
+            type=float,
+            default=0.05,
+    )
+    ap.add_argument('--note-probability',
+            help='Chance of a note on any given day',
+            type=float,
+            default=0.1,
+    )
+    ap.add_argument('--insulin',
+            help='Also write insulin rows',
+            action='store_true',
+    )
+    ap.add_argument('--exports',
+            help='Split the data into this many export files',
+            type=int,
+            default=1,
+    )
+    ap.add_argument('--overlap-days',
+            help='With --exports, how many days each export repeats from the one before',
+            type=int,
+            default=7,
+    )
+    ap.add_argument('--device',
+            help='Device name to write',
+            default='FreeStyle LibreLink',
+    )
+    ap.add_argument('--serial',
+            help='Serial number to write (default: derived from the seed)',
+    )
+    ap.add_argument('--generated-by',
+            help='Name for the "Generated by" line',
+            default=getpass.getuser(),
+    )
+
+    config = ap.parse_args()
+
+    main(config)
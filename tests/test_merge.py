@@ -0,0 +1,87 @@
+"""
+Merging overlapping exports: duplicate records collapse, and when records
+have a reading at the same minute the right one keeps its glucose.
+"""
+
+import glob
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import analyze  # noqa: E402
+
+HISTORIC = analyze.RECORD_TYPE_HISTORIC
+SCAN = analyze.RECORD_TYPE_SCAN
+MISSING = analyze.GLUCOSE_MISSING
+
+
+def stream(file_idx, rows, chunk_rows=2):
+    """
+    Yields (time, glucose, type, sn) rows as chunks of one file for
+    merge_cgm_chunks(), a few rows at a time so rows get merged across
+    chunk boundaries.
+    """
+    rows = sorted(rows)
+    for start in range(0, len(rows), chunk_rows):
+        time, glucose, record_type, sn = (np.array(column) for column in zip(*rows[start:start + chunk_rows]))
+        yield {
+            'time': time.astype(np.int64),
+            'glucose': glucose.astype(np.int16),
+            'type': record_type.astype(np.int8),
+            'sn': sn.astype(np.int32),
+            'file': np.full(len(time), file_idx, dtype=np.int32),
+            'note': np.full(len(time), None, dtype=object),
+        }
+
+
+def merge(*files):
+    """
+    Returns the merged rows of the given files (lists of rows) as a sorted
+    list of (time, glucose, type, sn).
+    """
+    chunks = list(analyze.merge_cgm_chunks([stream(file_idx, rows) for file_idx, rows in enumerate(files)]))
+    rows = analyze.concatenate_chunks(chunks)
+    return sorted(zip(*(rows[name].tolist() for name in ('time', 'glucose', 'type', 'sn'))))
+
+
+def test_identical_rows_collapse():
+    first = [(0, 100, HISTORIC, 0), (900, 110, HISTORIC, 0), (1800, 120, HISTORIC, 0), (1900, 125, SCAN, 0)]
+    second = first[1:] + [(2700, 130, HISTORIC, 0), (3600, 140, HISTORIC, 0)]
+    assert merge(first, second) == sorted(set(first + second))
+
+
+def test_scan_beats_historic_at_the_same_minute():
+    rows = [(0, 100, HISTORIC, 0), (900, 110, HISTORIC, 0), (900, 130, SCAN, 0), (1800, 120, HISTORIC, 0)]
+    # both records are kept, only the scan has a reading
+    expected = [(0, 100, HISTORIC, 0), (900, MISSING, HISTORIC, 0), (900, 130, SCAN, 0), (1800, 120, HISTORIC, 0)]
+    assert merge(rows) == expected
+    # no matter which file has which
+    assert merge(rows[:2] + rows[3:], [rows[2]]) == expected
+    assert merge([rows[2]], rows[:2] + rows[3:]) == expected
+
+
+def test_later_file_wins_with_equal_precedence():
+    # the same record in both files: only the later file's is kept
+    assert merge([(0, 100, HISTORIC, 0), (900, 110, HISTORIC, 0)], [(900, 115, HISTORIC, 0)]) == [(0, 100, HISTORIC, 0), (900, 115, HISTORIC, 0)]
+    # two sensors with a historic reading at the same minute: both records
+    # are kept, the later file's has the reading
+    assert merge([(900, 110, HISTORIC, 0)], [(900, 115, HISTORIC, 1)]) == sorted([(900, MISSING, HISTORIC, 0), (900, 115, HISTORIC, 1)])
+    assert merge([(900, 115, HISTORIC, 1)], [(900, 110, HISTORIC, 0)]) == sorted([(900, 110, HISTORIC, 0), (900, MISSING, HISTORIC, 1)])
+
+
+def test_overlapping_exports_load_like_one(tmp_path):
+    generate = [sys.executable, os.path.join(ROOT, 'bin', 'generate-data.py'), '--days', '20', '--start-date', '2026-01-01', '--seed', '2', '--note-probability', '0.5']
+    subprocess.run(generate + [str(tmp_path / 'full.csv')], check=True)
+    subprocess.run(generate + [str(tmp_path / 'part.csv'), '--exports', '3', '--overlap-days', '4'], check=True)
+    whole = analyze.load_cgm_data([str(tmp_path / 'full.csv')])
+    merged = analyze.load_cgm_data(sorted(glob.glob(str(tmp_path / 'part-*.csv'))))
+    for name in analyze.ROW_COLUMNS:
+        assert np.array_equal(whole[name], merged[name])
+    assert whole['serials'] == merged['serials']
+    assert np.array_equal(whole['note_time'], merged['note_time'])
+    assert whole['note_text'] == merged['note_text']
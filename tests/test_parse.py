@@ -0,0 +1,42 @@
+"""
+Device timestamps: the fast path for the usual LibreView format and the
+dateutil fallback for anything else have to agree.
+"""
+
+import datetime
+import os
+import sys
+
+import dateutil.parser
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import analyze  # noqa: E402
+
+
+@pytest.mark.parametrize('canonical, other, expected', [
+    ('01-02-2024 03:04 PM', '1/2/2024 15:04', datetime.datetime(2024, 1, 2, 15, 4)),
+    ('12-31-2023 12:00 AM', '2023-12-31T00:00:00', datetime.datetime(2023, 12, 31, 0, 0)),
+    ('02-29-2024 12:59 PM', 'Feb 29 2024 12:59 PM', datetime.datetime(2024, 2, 29, 12, 59)),
+    ('07-04-2025 11:30 AM', '07-04-2025 11:30 am', datetime.datetime(2025, 7, 4, 11, 30)),
+])
+def test_fallback_gives_the_same_epoch(canonical, other, expected):
+    epoch = int(analyze.datetime_to_epoch(expected))
+    # mixed in one column, so only the odd one goes through dateutil
+    assert analyze.parse_device_timestamps([canonical, other, canonical]).tolist() == [epoch, epoch, epoch]
+    assert analyze.parse_device_timestamps([other]).tolist() == [epoch]
+
+
+@pytest.mark.parametrize('timestamp', ['13-01-2024 01:00 PM', '01-02-2024 00:04 AM', '1-02-2024 03:04 PM', '01-02-2024 03:04 PM '])
+def test_not_quite_canonical_goes_to_dateutil(timestamp):
+    # these look like the usual format, but the fast path mustn't take them
+    expected = int(analyze.datetime_to_epoch(dateutil.parser.parse(timestamp)))
+    assert analyze.parse_device_timestamps([timestamp]).tolist() == [expected]
+
+
+def test_days_that_dont_exist_are_errors():
+    # rather than rolling over into the next month
+    with pytest.raises(ValueError):
+        analyze.parse_device_timestamps(['01-02-2024 03:04 PM', '02-30-2024 01:00 PM'])
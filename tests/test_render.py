@@ -0,0 +1,121 @@
+"""
+Graphs have to come out byte for byte the same however the tasks end up
+spread over the workers, or --incremental carries forward graphs that don't
+match what a fresh run would draw.
+"""
+
+import concurrent.futures
+import datetime
+import filecmp
+import glob
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import analyze  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def cgm_file(tmp_path_factory):
+    """
+    Three weeks of generated data up to yesterday, with a note every day so
+    the graphs have arrows to draw.
+    """
+    path = str(tmp_path_factory.mktemp('data') / 'export.csv')
+    start_date = datetime.date.today() - datetime.timedelta(days=21)
+    subprocess.run([
+        sys.executable, os.path.join(ROOT, 'bin', 'generate-data.py'), path,
+        '--days', '21', '--start-date', start_date.isoformat(), '--seed', '1', '--note-probability', '1',
+    ], check=True)
+    return path
+
+
+def rendered_files(reports_dir):
+    return sorted(os.path.basename(path) for path in glob.glob(os.path.join(reports_dir, '*.png')))
+
+
+def assert_same_graphs(expected_dir, actual_dir):
+    filenames = rendered_files(expected_dir)
+    assert filenames and filenames == rendered_files(actual_dir)
+    different = [f for f in filenames if not filecmp.cmp(os.path.join(expected_dir, f), os.path.join(actual_dir, f), shallow=False)]
+    assert different == []
+
+
+def test_render_independent_of_task_order(cgm_file, tmp_path):
+    config = analyze.build_arg_parser().parse_args(['--cgm-data', cgm_file, '--no-cache'])
+    current_datetime = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    data, notes, tasks, pending, fingerprints, manifest = analyze.prepare_reports(config, None, str(tmp_path / 'planned'), current_datetime)
+
+    def render(tasks, reports_dir, fresh):
+        os.makedirs(reports_dir)
+        analyze._plot_renderers.clear()
+        for task in tasks:
+            if fresh:
+                analyze._plot_renderers.clear()
+            output_file = os.path.join(reports_dir, os.path.basename(task.output_file))
+            task.function(*[output_file if arg is task.output_file else arg for arg in task.bind(data)])
+
+    # a new renderer for every graph is what nothing can leak into
+    render(tasks, str(tmp_path / 'fresh'), fresh=True)
+    render(tasks, str(tmp_path / 'forward'), fresh=False)
+    render(tasks[::-1], str(tmp_path / 'reversed'), fresh=False)
+    assert_same_graphs(str(tmp_path / 'fresh'), str(tmp_path / 'forward'))
+    assert_same_graphs(str(tmp_path / 'fresh'), str(tmp_path / 'reversed'))
+
+
+def test_render_independent_of_worker_count(cgm_file, tmp_path):
+    current_datetime = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    reports_dirs = []
+    for workers in (1, 3):
+        reports_dir = str(tmp_path / f'workers{workers}')
+        config = analyze.build_arg_parser().parse_args(['--cgm-data', cgm_file, '--no-cache'])
+        data, notes, tasks, pending, fingerprints, manifest = analyze.prepare_reports(config, None, reports_dir, current_datetime)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=analyze.init_worker) as executor:
+            task_timings, failures = analyze.render_reports(config, executor, data, tasks, pending, fingerprints, manifest)
+        assert failures == 0
+        reports_dirs.append(reports_dir)
+    assert_same_graphs(*reports_dirs)
+    with open(os.path.join(reports_dirs[0], 'manifest.json')) as f, open(os.path.join(reports_dirs[1], 'manifest.json')) as g:
+        assert f.read() == g.read()
+
+
+@pytest.mark.parametrize('filename, when', [
+    ('all-time-tz-graph.png', datetime.datetime(2026, 9, 26, 22)),
+    ('all-time-weeklytz-graph.png', datetime.datetime(2026, 9, 24, 12)),
+])
+def test_notes_in_last_bucket_are_drawn(tmp_path, monkeypatch, filename, when):
+    """
+    The points of time in zone graphs are the start of each bucket, notes
+    after the start of the last one up to the last reading still count.
+    """
+    # readings from 2026-09-14 00:06 to 09-26 23:51, so the last daily bucket
+    # starts on the 26th and the last weekly one on the 21st
+    path = str(tmp_path / 'export.csv')
+    subprocess.run([
+        sys.executable, os.path.join(ROOT, 'bin', 'generate-data.py'), path,
+        '--days', '13', '--start-date', '2026-09-14', '--seed', '1', '--note-probability', '0',
+    ], check=True)
+    config = analyze.build_arg_parser().parse_args(['--cgm-data', path, '--no-cache'])
+    data, notes, tasks, pending, fingerprints, manifest = analyze.prepare_reports(config, None, str(tmp_path / 'reports'), datetime.datetime(2026, 9, 27))
+    config.notes = analyze.NotesIndex([{'datetime': when, 'text': "Last bucket"}])
+    (task,) = [task for task in tasks if os.path.basename(task.output_file) == filename]
+    assert analyze.report_fingerprint(config, data, task) != fingerprints[task.output_file]
+
+    # matplotlib leaves out annotations whose point is outside the axes
+    drawn = []
+    annotate = analyze.import_plotting().axes.Axes.annotate
+
+    def spy(ax, text, xy, *args, **kwargs):
+        left, right = ax.get_xlim()
+        if left <= analyze.import_plotting().dates.date2num(xy[0]) <= right:
+            drawn.append(text)
+        return annotate(ax, text, xy, *args, **kwargs)
+    monkeypatch.setattr(analyze.import_plotting().axes.Axes, 'annotate', spy)
+    analyze._plot_renderers.clear()
+    task.function(*task.bind(data))
+    assert drawn == ["Last bucket"]
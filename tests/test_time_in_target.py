@@ -0,0 +1,88 @@
+"""
+The time in target index against a brute force integral of the line between
+the readings.
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import analyze  # noqa: E402
+
+TZ_MIN = 70
+TZ_MAX = 180
+
+
+def brute_force_zone_seconds(time_data, glucose, start, end, max_gap=None, step=0.01):
+    """
+    Returns (in_zone, below, above) seconds between start and end by
+    stepping along the line between every two readings that aren't a gap.
+    """
+    seconds = {0: 0.0, -1: 0.0, 1: 0.0}
+    for time_a, glucose_a, time_b, glucose_b in zip(time_data[:-1], glucose[:-1], time_data[1:], glucose[1:]):
+        if max_gap is not None and time_b - time_a > max_gap:
+            continue
+        lo, hi = max(time_a, start), min(time_b, end)
+        if hi <= lo:
+            continue
+        midpoints = np.arange(lo, hi, step) + step / 2
+        midpoints = midpoints[midpoints < hi]
+        zones = analyze.get_tz_state(TZ_MIN, TZ_MAX, np.interp(midpoints, [time_a, time_b], [glucose_a, glucose_b]))
+        for zone in seconds:
+            seconds[zone] += step * np.count_nonzero(zones == zone)
+    return (seconds[0], seconds[-1], seconds[1])
+
+
+def assert_matches_brute_force(time_data, glucose, windows, max_gap=None):
+    time_data = np.asarray(time_data, dtype=np.float64)
+    glucose = np.asarray(glucose, dtype=np.float64)
+    ratios = analyze.calculate_time_in_zones(TZ_MIN, TZ_MAX, time_data, glucose, windows, max_gap)
+    tz_index = analyze.build_time_in_target_index(TZ_MIN, TZ_MAX, time_data, glucose, max_gap)
+    for i, (start, end) in enumerate(windows):
+        expected = brute_force_zone_seconds(time_data, glucose, start, end, max_gap)
+        seconds = analyze.zone_seconds_from_index(tz_index, start, end)
+        assert [float(s) for s in seconds] == pytest.approx(expected, abs=0.05)
+        total = sum(expected)
+        # windows without any data are 0 in every zone
+        assert [float(ratio[i]) for ratio in ratios] == pytest.approx([s / total if total else 0 for s in expected], abs=1e-3)
+
+
+def test_crossing_from_below_to_above():
+    # 50 -> 250 over 100s crosses 70 at 10s and 180 at 65s
+    ratios = analyze.calculate_time_in_zones(TZ_MIN, TZ_MAX, np.array([0.0, 100.0]), np.array([50.0, 250.0]), [(0, 100)])
+    assert [float(ratio[0]) for ratio in ratios] == pytest.approx([0.55, 0.10, 0.35])
+    assert_matches_brute_force([0, 100], [50, 250], [(0, 100), (5, 70), (20, 40)])
+
+
+def test_crossing_from_above_to_below():
+    # 250 -> 50 over 100s crosses 180 at 35s and 70 at 90s
+    ratios = analyze.calculate_time_in_zones(TZ_MIN, TZ_MAX, np.array([0.0, 100.0]), np.array([250.0, 50.0]), [(0, 100)])
+    assert [float(ratio[0]) for ratio in ratios] == pytest.approx([0.55, 0.10, 0.35])
+    assert_matches_brute_force([0, 100], [250, 50], [(0, 100), (30, 95)])
+
+
+def test_windows_cutting_segments():
+    time_data = [0, 100, 200, 300, 400]
+    glucose = [100, 200, 60, 150, 190]
+    # every window starts or ends half way through a segment
+    windows = [(50, 150), (150, 350), (25, 375), (0, 400), (310, 390)]
+    assert_matches_brute_force(time_data, glucose, windows)
+
+
+def test_gaps_are_left_out():
+    # 100 -> 300 is a gap with max_gap 150, as is the stretch before 1000
+    time_data = [0, 100, 300, 400, 1000, 1100]
+    glucose = [60, 190, 100, 60, 200, 100]
+    windows = [(0, 1100), (50, 350), (150, 250), (350, 1050)]
+    assert_matches_brute_force(time_data, glucose, windows, max_gap=150)
+
+    tz_index = analyze.build_time_in_target_index(TZ_MIN, TZ_MAX, np.array(time_data, dtype=np.float64), np.array(glucose, dtype=np.float64), 150)
+    # a window entirely inside a gap has no data at all
+    assert float(analyze.coverage_from_index(tz_index, 150, 250)) == 0
+    assert [float(ratio) for ratio in analyze.time_in_zones_from_index(tz_index, 150, 250)] == [0, 0, 0]
+    assert float(analyze.coverage_from_index(tz_index, 0, 1100)) == pytest.approx(300 / 1100)